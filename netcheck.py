@@ -14,10 +14,16 @@
 
 
 #!/usr/bin/env python
+import array
 import random
 import logging
 import itertools
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logging.basicConfig()
 logger = logging.getLogger()
 
@@ -59,10 +65,56 @@ class Arc(object):
 
 
 class NetChecker(object):
-    def __init__(self, nodes, arcs):
+    engines = ('search', 'unionfind', 'matrix')
+
+    def __init__(self, nodes, arcs, engine='search'):
+        """ engine is either 'search' which looks for topologies from
+        every vertex, or 'unionfind' which finds isolated fully connected
+        groups of vertices in near-linear time and searches only the rest
+        of vertices, or 'matrix' which finds the same groups with NumPy
+        adjacency matrix. All of them return the same topologies.
+        """
+        if engine not in self.engines:
+            raise ValueError("Unknown engine: %s" % engine)
         self.nodes = nodes
         self.arcs = arcs
+        self.engine = engine
         logger.debug("Init: got %d nodes and %d arcs", len(nodes), len(self.arcs))
+        self._build_index()
+
+    def _build_index(self):
+        """ Numbers vertices in order of appearance and stores arcs as
+        CSR adjacency: targets of arcs going out of vertex i are
+        self.adjacency[self.offsets[i]:self.offsets[i + 1]], they keep
+        the order of self.arcs.
+        """
+        self.vertices = []
+        self.vertex_ids = {}
+        sources = array.array('l')
+        targets = array.array('l')
+        for arc in self.arcs:
+            sources.append(self._vertex_id(arc[0]))
+            targets.append(self._vertex_id(arc[1]))
+
+        offsets = [0] * (len(self.vertices) + 1)
+        for source in sources:
+            offsets[source + 1] += 1
+        for i in xrange(len(self.vertices)):
+            offsets[i + 1] += offsets[i]
+        self.offsets = array.array('l', offsets)
+
+        self.adjacency = array.array('l', [0]) * len(targets)
+        for source, target in itertools.izip(sources, targets):
+            self.adjacency[offsets[source]] = target
+            offsets[source] += 1
+        logger.debug("Init: indexed %d vertices", len(self.vertices))
+
+    def _vertex_id(self, vertex):
+        vertex_id = self.vertex_ids.get(vertex)
+        if vertex_id is None:
+            vertex_id = self.vertex_ids[vertex] = len(self.vertices)
+            self.vertices.append(vertex)
+        return vertex_id
 
     @staticmethod
     def _invert_arc(arc):
@@ -89,12 +141,25 @@ class NetChecker(object):
         """
         topos = []
         vertices = set([i[0] for i in self.arcs])
+        cliques = {}
+        if self.engine == 'unionfind':
+            cliques = self._find_cliques()
+        elif self.engine == 'matrix':
+            cliques = self._find_cliques_matrix()
         logger.debug("Get_choices: start with %d vertices", len(vertices))
         while vertices:
             logger.debug("")
             vertex = vertices.pop()
             logger.debug("Get_choices: entry vertex is %s", vertex)
-            good_topos, visited_vertices = self._calc_topo(vertex)
+            # vertices are taken in the same order by both engines, so
+            # results are the same
+            clique = cliques.get(vertex)
+            if clique is not None:
+                topo = self._validate_topo(clique, [])
+                good_topos = [topo] if topo else []
+                visited_vertices = clique
+            else:
+                good_topos, visited_vertices = self._calc_topo(vertex)
             logger.debug("Get_choices: getted %d good_topos",
                          len(good_topos))
             logger.debug("Get_choices: getted %d visited_vertices: %s",
@@ -106,34 +171,137 @@ class NetChecker(object):
                          len(vertices), vertices)
         return self._uniq_topos(topos)
 
+    def _find_cliques(self):
+        """ Joins vertices having arcs to each other in both directions
+        into components with union-find. Component is a clique if each
+        its vertex has exactly one arc to each vertex of the component,
+        itself included, and no arc joins it with other vertices. Search
+        started from any vertex of a clique finds just all its vertices
+        and no failed ones, so it is not run for them.
+        Returns {vertex: list of vertices of its clique}.
+        """
+        count = len(self.vertices)
+        parent = range(count)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def neighbors(i):
+            return self.adjacency[self.offsets[i]:self.offsets[i + 1]]
+
+        neighbor_sets = [frozenset(neighbors(i)) for i in xrange(count)]
+        for a in xrange(count):
+            root_a = find(a)
+            for b in neighbor_sets[a]:
+                if b > a and a in neighbor_sets[b]:
+                    root_b = find(b)
+                    if root_a != root_b:
+                        parent[root_b] = root_a
+
+        roots = [find(i) for i in xrange(count)]
+        components = {}
+        for i in xrange(count):
+            components.setdefault(roots[i], []).append(i)
+        broken = set()
+        for a in xrange(count):
+            root_a = roots[a]
+            for b in neighbor_sets[a]:
+                if roots[b] != root_a:
+                    broken.add(root_a)
+                    broken.add(roots[b])
+
+        cliques = {}
+        for root, members in components.iteritems():
+            if root in broken:
+                continue
+            size = len(members)
+            if any(len(neighbors(i)) != size or
+                   len(neighbor_sets[i]) != size for i in members):
+                continue
+            clique = [self.vertices[i] for i in members]
+            for vertex in clique:
+                cliques[vertex] = clique
+        logger.debug("_find_cliques: %d of %d vertices are in cliques",
+                     len(cliques), count)
+        return cliques
+
+    def _find_cliques_matrix(self):
+        """ Finds the same cliques as _find_cliques with arcs held as
+        boolean adjacency matrix A. Row and column of A of a clique
+        vertex are both equal to its row of A & A.T, which is true for
+        vertices of the clique only. Falls back to _find_cliques if NumPy
+        is not installed.
+        """
+        if numpy is None:
+            logger.debug("_find_cliques_matrix: NumPy is not installed, "
+                         "falling back to union-find")
+            return self._find_cliques()
+        count = len(self.vertices)
+        if not count:
+            return {}
+        degrees = numpy.diff(numpy.frombuffer(self.offsets, dtype=numpy.int_))
+        sources = numpy.repeat(numpy.arange(count), degrees)
+        targets = numpy.frombuffer(self.adjacency, dtype=numpy.int_)
+        matrix = numpy.zeros((count, count), dtype=bool)
+        matrix[sources, targets] = True
+
+        mutual = matrix & matrix.T
+        sizes = mutual.sum(axis=1)
+        # repeated arcs make degree bigger than row sum
+        candidates = numpy.flatnonzero(
+            numpy.diagonal(matrix) & (sizes == degrees) &
+            (sizes == matrix.sum(axis=1)) & (sizes == matrix.sum(axis=0)))
+
+        groups = {}
+        rows = numpy.packbits(mutual[candidates], axis=1)
+        for i, row in itertools.izip(candidates, rows):
+            groups.setdefault(row.tostring(), []).append(i)
+        cliques = {}
+        for members in groups.itervalues():
+            # every member is in the row, so it is the clique if sizes match
+            if sizes[members[0]] != len(members):
+                continue
+            clique = [self.vertices[i] for i in members]
+            for vertex in clique:
+                cliques[vertex] = clique
+        logger.debug("_find_cliques_matrix: %d of %d vertices are in "
+                     "cliques", len(cliques), count)
+        return cliques
+
     def _calc_topo(self, start_vertex):
         topos = []
         visited_vertices = set()
 
         def extend_arcs_to_check(arcs_to_check, arcs):
             for failed_v, ignored_v in arcs:
-                existed_arcs = filter(
-                    lambda x: x[0] == failed_v, arcs_to_check)
-                if existed_arcs:
-                    existed_arc = existed_arcs[0]
-                    existed_arc[1].append(ignored_v)
-                else:
-                    arcs_to_check.append((failed_v, [ignored_v]))
+                ignored = ignored_by_failed.get(failed_v)
+                if ignored is None:
+                    ignored = ignored_by_failed[failed_v] = []
+                    arcs_to_check.append((failed_v, ignored))
+                ignored.append(ignored_v)
 
         # arcs_to_check consists of arcs (x, y) where
         # x - failed vertex,
         # y - list of vertices which should be ignored.
         arcs_to_check = [(start_vertex, [])]
+        ignored_by_failed = {start_vertex: arcs_to_check[0][1]}
         for fv, ignored_vertices in arcs_to_check:
+            ignored_vertices = set(ignored_vertices)
             found_vertices = [fv]
+            # found_vertices may repeat a vertex if arcs are repeated
+            found_counts = {fv: 1}
             failed_arcs = []
+            failed_arcs_set = set()
 
             for vertex in found_vertices:
                 neighbors = self._get_neighbors(vertex)
                 logger.debug("_calc_topo: for vtx %s a neigbors found: %s",
                              vertex, neighbors)
                 new_vertices, absent_vertices = self._diff_lists(
-                    found_vertices, ignored_vertices, neighbors
+                    found_vertices, found_counts, ignored_vertices, neighbors
                 )
                 logger.debug("_calc_topo: new vtx found: %s", new_vertices)
                 logger.debug("_calc_topo: absent_vertices is %s",
@@ -141,9 +309,12 @@ class NetChecker(object):
                 if absent_vertices:
                     for v in absent_vertices:
                         failed_arc = (v, vertex)
-                        if failed_arc not in failed_arcs:
+                        if failed_arc not in failed_arcs_set:
+                            failed_arcs_set.add(failed_arc)
                             failed_arcs.append(failed_arc)
                 found_vertices.extend(new_vertices)
+                for v in new_vertices:
+                    found_counts[v] = found_counts.get(v, 0) + 1
 
             failed_vertices = [x[0] for x in failed_arcs]
             topo = self._validate_topo(found_vertices, failed_vertices)
@@ -155,27 +326,56 @@ class NetChecker(object):
         return topos, visited_vertices
 
     def _get_neighbors(self, vertex):
-        arcs = filter(
-            lambda x: x[0] == vertex,
-            self.arcs)
-        return [x[1] for x in arcs]
+        # _diff_lists modifies the list, so it is built on every call
+        vertex_id = self.vertex_ids.get(vertex)
+        if vertex_id is None:
+            return []
+        return [self.vertices[i] for i in self.adjacency[
+            self.offsets[vertex_id]:self.offsets[vertex_id + 1]]]
 
     @staticmethod
-    def _diff_lists(found_vertices, ignored_vertices, neighbours):
-        new_vertices = []
+    def _diff_lists(found_vertices, found_counts, ignored_vertices,
+                    neighbours):
+        """ Matches every neighbour with one found vertex equal to it,
+        earlier found vertices and earlier neighbours are matched first.
+        Returns not matched neighbours which are not ignored and not
+        matched found vertices, both in their original order.
+        found_counts maps found vertices to number of their occurrences,
+        ignored_vertices is a set.
+        """
+        available = {}
+        for n in neighbours:
+            available[n] = available.get(n, 0) + 1
+        matched = {}
+        matched_total = 0
+        for n, count in available.iteritems():
+            count = min(count, found_counts.get(n, 0))
+            if count:
+                matched[n] = count
+                matched_total += count
+
         absent_vertices = []
-        for n in found_vertices:
-            if n in neighbours:
-                neighbours.remove(n)
-            else:
-                absent_vertices.append(n)
-        new_vertices = [n for n in neighbours if n not in ignored_vertices]
+        if matched_total < len(found_vertices):
+            left = dict(matched)
+            for n in found_vertices:
+                if left.get(n):
+                    left[n] -= 1
+                else:
+                    absent_vertices.append(n)
+
+        new_vertices = []
+        for n in neighbours:
+            if matched.get(n):
+                matched[n] -= 1
+            elif n not in ignored_vertices:
+                new_vertices.append(n)
         return new_vertices, absent_vertices
 
     def _validate_topo(self, found_v, failed_v):
         logger.debug("_validate_topo: found_vertices is: %s", found_v)
         logger.debug("_validate_topo: failed_vertices is: %s", failed_v)
         topo = {}
+        failed_v = set(failed_v)
         for v in found_v:
             if v in failed_v:
                 continue
@@ -192,23 +392,35 @@ class NetChecker(object):
         return topo
 
     def _uniq_topos(self, topos):
-        def isincluded(topo, topos):
-            for at in topos:
-                included = True
-                for n in self.nodes:
-                    if not set(topo[n]).issubset(set(at[n])):
-                        included = False
-                if included:
-                    return True
-            return False
-
-        copy = []
+        """ Drops topologies included into other ones. Every topology is
+        encoded as bitmask of its (node, interface) slots, so inclusion
+        is one bitwise operation. The biggest topologies are checked first
+        and only those not included into already kept ones are kept. Of
+        equal topologies the first one is kept. Kept topologies are
+        returned in their original order.
+        """
         logger.debug("_uniq_topos: topos is %s" % topos)
-        for t in topos:
-            logger.debug("_uniq_topos: now testing: %s" % t)
-            if not isincluded(t, [i for i in topos if id(i) != id(t)]):
-                copy.append(t) 
-        return copy
+        slots = {}
+        masks = []
+        for topo in topos:
+            mask = 0
+            for node, interfaces in topo.iteritems():
+                for interface in interfaces:
+                    mask |= 1 << slots.setdefault((node, interface),
+                                                  len(slots))
+            masks.append(mask)
+
+        kept = []
+        kept_masks = []
+        for i in sorted(xrange(len(topos)),
+                        key=lambda i: -bin(masks[i]).count('1')):
+            mask = masks[i]
+            if any(mask & k == mask for k in kept_masks):
+                logger.debug("_uniq_topos: dropped: %s" % topos[i])
+                continue
+            kept.append(i)
+            kept_masks.append(mask)
+        return [topos[i] for i in sorted(kept)]
 
 
 class ClassbasedNetChecker(NetChecker):
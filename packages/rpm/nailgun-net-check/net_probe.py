@@ -18,26 +18,93 @@
 # Collect data from interfaces.
 # Analyse dumps for packets with special cookie in UDP payload.
 #
-import os
 import sys
+import time
+import __builtin__
+
+
+class ImportProfiler(object):
+    """
+    Measures time of first import of every module. Time of nested
+    imports is included into time of the module importing them.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.times = {}
+        self._import = __builtin__.__import__
+
+    def install(self):
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+    def timed_import(self, name, *args, **kwargs):
+        if name in sys.modules or name in self.times:
+            return self._import(name, *args, **kwargs)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            self.times[name] = time.time() - start
+
+    def report(self, limit=20):
+        lines = ["Startup took %.3f seconds, slowest imports:" %
+                 (time.time() - self.started)]
+        for name, spent in sorted(self.times.iteritems(),
+                                  key=lambda item: -item[1])[:limit]:
+            lines.append("%8.3f  %s" % (spent, name))
+        return '\n'.join(lines)
+
+
+# Installed before the rest of modules is imported, so they are measured too.
+import_profiler = None
+if __name__ == "__main__" and '--profile-startup' in sys.argv:
+    import_profiler = ImportProfiler()
+    import_profiler.install()
+
+import os
+import errno
 import signal
+import shutil
+import tempfile
+import resource
 import json
+import mmap
 import socket
-import time
+import struct
+import select
 import re
 import logging
 import logging.handlers
 import argparse
 import functools
+import itertools
 import threading
 import traceback
+import ctypes
+import ctypes.util
 from subprocess import Popen, PIPE
 
 import pcap
-import scapy.config as scapy
-scapy.conf.logLevel = 40
-scapy.conf.use_pcap = True
-import scapy.all as scapy
+
+
+_scapy = None
+
+
+def load_scapy():
+    """
+    Imports scapy on first use. It takes seconds on slow nodes while it is
+    needed only by scapy engine and for frames fast decoder can not parse.
+    """
+    global _scapy
+    if _scapy is None:
+        import scapy.config
+        scapy.config.conf.logLevel = 40
+        scapy.config.conf.use_pcap = True
+        import scapy.all
+        _scapy = scapy.all
+    return _scapy
 
 
 class ActorFabric(object):
@@ -50,6 +117,10 @@ class ActorFabric(object):
             return Listener(config)
         elif config['action'] in ('generate',):
             return Sender(config)
+        elif config['action'] in ('benchmark',):
+            return Benchmark(config)
+        elif config['action'] in ('agent',):
+            return Agent(config)
 
 
 class ActorException(Exception):
@@ -58,7 +129,1018 @@ class ActorException(Exception):
         super(ActorException, self).__init__(message)
 
 
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+
+
+def _mac_to_bytes(mac):
+    return ''.join(chr(int(octet, 16)) for octet in mac.split(':'))
+
+
+def _inet_checksum(data):
+    if len(data) % 2:
+        data += '\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class ProbeFrame(object):
+    """
+    Pre-serialized probe frame. Ethernet, IP and UDP headers are built
+    only once, so producing a frame for any vlan is just patching
+    802.1Q tag bytes in the tagged template.
+    """
+    def __init__(self, src_mac, src, dst, sport, dport, data):
+        src_ip = socket.inet_aton(src)
+        dst_ip = socket.inet_aton(dst)
+        udp_len = 8 + len(data)
+        pseudo = struct.pack('!4s4sBBH', src_ip, dst_ip, 0, socket.IPPROTO_UDP,
+                             udp_len)
+        udp = struct.pack('!HHHH', sport, dport, udp_len, 0)
+        udp_csum = _inet_checksum(pseudo + udp + data) or 0xffff
+        udp = struct.pack('!HHHH', sport, dport, udp_len, udp_csum)
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + udp_len, 1, 0, 64,
+                         socket.IPPROTO_UDP, 0, src_ip, dst_ip)
+        ip = ip[:10] + struct.pack('!H', _inet_checksum(ip)) + ip[12:]
+        macs = _mac_to_bytes(BROADCAST_MAC) + _mac_to_bytes(src_mac)
+
+        packet = ip + udp + data
+        self.untagged = macs + struct.pack('!H', ETH_P_IP) + packet
+        self._tagged = bytearray(
+            macs + struct.pack('!HHH', ETH_P_8021Q, 0, ETH_P_IP) + packet)
+
+    def frame(self, vlan=0):
+        if not vlan:
+            return self.untagged
+        self._tagged[14:16] = struct.pack('!H', vlan & 0x0fff)
+        return str(self._tagged)
+
+
+def decode_probe_frame(pkt, cookie):
+    """
+    Looks for probe payload in raw ethernet frame using fixed header
+    offsets only, nothing is copied except the payload itself. Cookie
+    may be a tuple of cookies, payload starting with any of them is
+    a probe.
+    :returns:
+    (vlan, dport, payload) if frame is a probe or None otherwise
+    :raises:
+    ValueError if frame is truncated or has broken headers
+    """
+    length = len(pkt)
+    if length < 14:
+        raise ValueError("Frame is too short")
+    vlan = 0
+    offset = 12
+    ethertype, = struct.unpack_from('!H', pkt, offset)
+    if ethertype == ETH_P_8021Q:
+        if length < 18:
+            raise ValueError("Frame is too short")
+        tci, ethertype = struct.unpack_from('!HH', pkt, 14)
+        vlan = tci & 0x0fff
+        offset = 16
+    offset += 2
+    if ethertype != ETH_P_IP:
+        # ARP, IPv6, STP and such are well formed frames, not probes
+        return None
+
+    if length < offset + 20:
+        raise ValueError("IP header is truncated")
+    ver_ihl, = struct.unpack_from('!B', pkt, offset)
+    ihl = (ver_ihl & 0x0f) * 4
+    if ver_ihl >> 4 != 4 or ihl < 20:
+        raise ValueError("IP header is broken")
+    frag, _, proto = struct.unpack_from('!HBB', pkt, offset + 6)
+    if proto != socket.IPPROTO_UDP or frag & 0x1fff:
+        return None
+
+    offset += ihl
+    if length < offset + 8:
+        raise ValueError("UDP header is truncated")
+    dport, udp_len = struct.unpack_from('!HH', pkt, offset + 2)
+    end = offset + udp_len
+    if udp_len < 8 or end > length:
+        raise ValueError("UDP length is broken")
+    offset += 8
+    if not pkt.startswith(cookie, offset, end):
+        return None
+    return vlan, dport, pkt[offset:end]
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _libc_function(name):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+
+
+def _iface_index(iface):
+    with open("/sys/class/net/%s/ifindex" % iface) as f:
+        return int(f.read())
+
+
+class RawSocket(object):
+    """
+    AF_PACKET socket bound to physical interface. Frames are written
+    as is, so they have to carry 802.1Q tag by themselves. Batches are
+    pushed with a single sendmmsg(2) call when libc and kernel support
+    it, otherwise frames are sent one by one.
+    """
+    batch_size = 256
+
+    _sendmmsg = _libc_function('sendmmsg')
+
+    def __init__(self, iface):
+        self.iface = iface
+        # Protocol 0 means that socket is used for sending only and
+        # kernel does not queue any received frames on it.
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self.sock.bind((iface, 0))
+
+    def close(self):
+        self.sock.close()
+
+    def send_frames(self, frames):
+        for i in xrange(0, len(frames), self.batch_size):
+            batch = frames[i:i + self.batch_size]
+            if self._sendmmsg is None or not self._send_batch(batch):
+                for frame in batch:
+                    self.sock.send(frame)
+
+    def _send_batch(self, frames):
+        count = len(frames)
+        buf = ctypes.create_string_buffer(''.join(frames))
+        iovs = (_iovec * count)()
+        msgs = (_mmsghdr * count)()
+        offset = 0
+        for i, frame in enumerate(frames):
+            iovs[i].iov_base = ctypes.addressof(buf) + offset
+            iovs[i].iov_len = len(frame)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+            offset += len(frame)
+
+        sent = 0
+        while sent < count:
+            r = self._sendmmsg(
+                self.sock.fileno(),
+                ctypes.byref(msgs, sent * ctypes.sizeof(_mmsghdr)),
+                count - sent, 0)
+            if r < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSYS and not sent:
+                    # libc has wrapper but kernel does not have syscall
+                    RawSocket._sendmmsg = None
+                    return False
+                if err == errno.EINTR:
+                    continue
+                raise socket.error(err, os.strerror(err))
+            sent += r
+        return True
+
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+IFLA_IFNAME = 3
+IFLA_LINK = 5
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_VLAN_ID = 1
+IFF_UP = 0x1
+
+NLMSGHDR = struct.Struct('=LHHLL')
+IFINFOMSG = struct.Struct('=BxHiII')
+RTATTR = struct.Struct('=HH')
+
+
+def _rtattrs(data, offset, end):
+    """
+    Iterates over (type, value) of netlink attributes in data[offset:end]
+    """
+    while offset + RTATTR.size <= end:
+        length, rta_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        yield rta_type & 0x7fff, data[offset + RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+class LinkCache(object):
+    """
+    In-memory index of network links. All links are dumped once through
+    rtnetlink socket which stays subscribed to link events afterwards.
+    Every query applies pending RTM_NEWLINK/RTM_DELLINK events first, so
+    answers are never older than the last change made to links.
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_ROUTE)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((0, RTMGRP_LINK))
+        self.seq = 0
+        self.snapshot()
+
+    def close(self):
+        self.sock.close()
+
+    def snapshot(self):
+        self.links = {}
+        self.by_name = {}
+        self.by_vid = {}
+        self.seq += 1
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload),
+                                     RTM_GETLINK, NLM_F_REQUEST | NLM_F_DUMP,
+                                     self.seq, 0) + payload)
+        done = False
+        while not done:
+            done = self._process(self.sock.recv(1 << 16))
+
+    def refresh(self):
+        while True:
+            try:
+                data = self.sock.recv(1 << 16, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] == errno.ENOBUFS:
+                    # some events were lost, the only way to be in sync
+                    # is to dump all links again
+                    self.snapshot()
+                    continue
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self._process(data)
+
+    def _process(self, data):
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            length, msg_type, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+            if length < NLMSGHDR.size:
+                break
+            if msg_type == NLMSG_DONE and seq == self.seq:
+                return True
+            if msg_type == NLMSG_ERROR and seq == self.seq:
+                raise socket.error("Netlink dump of links failed")
+            if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                self._apply(msg_type, data, offset + NLMSGHDR.size,
+                            offset + length)
+            offset += (length + 3) & ~3
+        return False
+
+    def _apply(self, msg_type, data, offset, end):
+        _, _, index, flags, _ = IFINFOMSG.unpack_from(data, offset)
+        self._forget(index)
+        if msg_type == RTM_DELLINK:
+            return
+
+        link = {'name': None, 'flags': flags, 'parent': None, 'vid': None}
+        kind = None
+        for rta_type, value in _rtattrs(data, offset + IFINFOMSG.size, end):
+            if rta_type == IFLA_IFNAME:
+                link['name'] = value.rstrip('\x00')
+            elif rta_type == IFLA_LINK:
+                link['parent'] = struct.unpack('=i', value[:4])[0]
+            elif rta_type == IFLA_LINKINFO:
+                for info_type, info in _rtattrs(value, 0, len(value)):
+                    if info_type == IFLA_INFO_KIND:
+                        kind = info.rstrip('\x00')
+                    elif info_type == IFLA_INFO_DATA and kind == 'vlan':
+                        for vlan_type, vlan in _rtattrs(info, 0, len(info)):
+                            if vlan_type == IFLA_VLAN_ID:
+                                link['vid'] = struct.unpack('=H',
+                                                            vlan[:2])[0]
+        self.links[index] = link
+        self.by_name[link['name']] = index
+        if link['vid'] is not None:
+            self.by_vid[(link['parent'], link['vid'])] = index
+
+    def _forget(self, index):
+        link = self.links.pop(index, None)
+        if link is None:
+            return
+        if self.by_name.get(link['name']) == index:
+            del self.by_name[link['name']]
+        if self.by_vid.get((link['parent'], link['vid'])) == index:
+            del self.by_vid[(link['parent'], link['vid'])]
+
+    def state(self, name):
+        """
+        :returns:
+        'UP' or 'DOWN' if link exists or None
+        """
+        self.refresh()
+        index = self.by_name.get(name)
+        if index is None:
+            return None
+        return 'UP' if self.links[index]['flags'] & IFF_UP else 'DOWN'
+
+    def vlan_name(self, iface, vid):
+        """
+        :returns:
+        name of vlan link with VLAN_ID=vid on link iface or None
+        """
+        self.refresh()
+        index = self.by_vid.get((self.by_name.get(iface), vid))
+        if index is None:
+            return None
+        return self.links[index]['name']
+
+
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MSH = 0xa0
+BPF_JEQ = 0x10
+BPF_JSET = 0x40
+BPF_K = 0x00
+SO_ATTACH_FILTER = 26
+
+
+class _sock_filter(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_uint16),
+                ('jt', ctypes.c_uint8),
+                ('jf', ctypes.c_uint8),
+                ('k', ctypes.c_uint32)]
+
+
+class _sock_fprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_ushort),
+                ('filter', ctypes.POINTER(_sock_filter))]
+
+
+def _bpf_assemble(program):
+    """
+    Resolves labels in program to classic BPF instructions.
+    Program is a list of label strings and (code, jt, jf, k) tuples where
+    jt and jf are either labels or None for the next instruction.
+    """
+    labels = {}
+    insns = []
+    for item in program:
+        if isinstance(item, str):
+            labels[item] = len(insns)
+        else:
+            insns.append(item)
+    result = []
+    for pc, (code, jt, jf, k) in enumerate(insns):
+        jt = labels[jt] - pc - 1 if jt else 0
+        jf = labels[jf] - pc - 1 if jf else 0
+        if max(jt, jf) > 255:
+            raise ValueError("BPF jump is too long: %d" % max(jt, jf))
+        result.append((code, jt, jf, k))
+    return result
+
+
+def _cookie_chunks(cookie):
+    """
+    Splits cookie into (offset, size, value) chunks of 4, 2 and 1 bytes
+    which can be compared by BPF load instructions.
+    """
+    chunks = []
+    offset = 0
+    while offset < len(cookie):
+        size = 4 if len(cookie) - offset >= 4 else (
+            2 if len(cookie) - offset >= 2 else 1)
+        value = int(cookie[offset:offset + size].encode('hex'), 16)
+        chunks.append((offset, size, value))
+        offset += size
+    return chunks
+
+
+def probe_pcap_filter(probes, vlan=False):
+    """
+    Generates pcap filter expression matching probes of any of (dport,
+    cookie) pairs, cookie is checked at the beginning of UDP payload, so
+    nothing else reaches Python.
+    """
+    alternatives = []
+    for dport, cookie in probes:
+        alternative = 'dst port {0}'.format(dport)
+        for offset, size, value in _cookie_chunks(cookie):
+            alternative += ' and udp[{0}:{1}] = {2:#x}'.format(8 + offset,
+                                                               size, value)
+        alternatives.append('({0})'.format(alternative))
+    filter_string = 'udp and ({0})'.format(' or '.join(alternatives))
+    if vlan:
+        filter_string = 'vlan and {0}'.format(filter_string)
+    return filter_string
+
+
+def probe_bpf_program(probes):
+    """
+    Generates classic BPF program accepting IPv4 UDP frames matching any
+    of (dport, cookie) pairs, cookie is checked at the beginning of
+    payload. Frames are accepted either with or without 802.1Q header
+    (AF_PACKET sockets usually get frames with vlan tag moved into
+    metadata).
+    """
+    load_size = {4: BPF_W, 2: BPF_H, 1: BPF_B}
+    program = [
+        (BPF_LD | BPF_H | BPF_ABS, None, None, 12),
+        (BPF_JMP | BPF_JEQ | BPF_K, 'tagged', 'untagged', ETH_P_8021Q),
+    ]
+    for label, l2_len in (('untagged', 14), ('tagged', 18)):
+        program.extend([
+            label,
+            (BPF_LD | BPF_H | BPF_ABS, None, None, l2_len - 2),
+            (BPF_JMP | BPF_JEQ | BPF_K, None, 'reject', ETH_P_IP),
+            (BPF_LD | BPF_B | BPF_ABS, None, None, l2_len + 9),
+            (BPF_JMP | BPF_JEQ | BPF_K, None, 'reject', socket.IPPROTO_UDP),
+            (BPF_LD | BPF_H | BPF_ABS, None, None, l2_len + 6),
+            (BPF_JMP | BPF_JSET | BPF_K, 'reject', None, 0x1fff),
+            (BPF_LDX | BPF_B | BPF_MSH, None, None, l2_len),
+        ])
+        # X still holds IP header length, so payload starts at X + l2_len
+        # + 8. Loads beyond the end of frame reject it.
+        for number, (dport, cookie) in enumerate(probes):
+            mismatch = '%s_%d' % (label, number + 1)
+            if number + 1 == len(probes):
+                mismatch = 'reject'
+            program.extend([
+                (BPF_LD | BPF_H | BPF_IND, None, None, l2_len + 2),
+                (BPF_JMP | BPF_JEQ | BPF_K, None, mismatch, dport),
+            ])
+            for offset, size, value in _cookie_chunks(cookie):
+                program.extend([
+                    (BPF_LD | load_size[size] | BPF_IND, None, None,
+                     l2_len + 8 + offset),
+                    (BPF_JMP | BPF_JEQ | BPF_K, None, mismatch, value),
+                ])
+            program.extend([(BPF_RET | BPF_K, None, None, 0xffff),
+                            mismatch])
+    program.append((BPF_RET | BPF_K, None, None, 0))
+    return _bpf_assemble(program)
+
+
+def attach_bpf(sock, program):
+    insns = (_sock_filter * len(program))(*program)
+    fprog = _sock_fprog(len(program), insns)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                    ctypes.string_at(ctypes.addressof(fprog),
+                                     ctypes.sizeof(fprog)))
+
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 0x1
+TP_STATUS_VLAN_VALID = 0x10
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_DROP_MEMBERSHIP = 2
+PACKET_MR_PROMISC = 1
+PACKET_MREQ = struct.Struct('=iHH8s')
+
+BLOCK_DESC = struct.Struct('=III')
+TPACKET3_HDR = struct.Struct('=IIIIIIHHII')
+
+
+class PcapCapture(object):
+    """
+    Non-blocking libpcap capture. It has the same interface as
+    RingCapture, so both can be driven by one event loop.
+    """
+    def __init__(self, iface, filter_string):
+        self.iface = iface
+        self.pc = pcap.pcap(iface)
+        self.pc.setfilter(filter_string)
+        self.pc.setnonblock(True)
+
+    def fileno(self):
+        return self.pc.fileno()
+
+    def close(self):
+        pass
+
+    def frames(self):
+        frames = []
+        self.pc.dispatch(-1, lambda ts, pkt: frames.append((None, pkt)))
+        return frames
+
+
+class PcapFile(object):
+    """
+    Reads frames recorded in pcap file. It has the same interface as
+    live captures, so recorded traffic goes through the same decoding
+    and aggregation.
+    """
+    LINKTYPE_ETHERNET = 1
+
+    def __init__(self, iface, filename):
+        self.iface = iface
+        self.fo = open(filename, 'rb')
+        header = self.fo.read(24)
+        if len(header) < 24:
+            raise ValueError("%s is not a pcap file" % filename)
+        for endian in ('<', '>'):
+            magic, = struct.unpack(endian + 'I', header[:4])
+            if magic in (0xa1b2c3d4, 0xa1b23c4d):
+                break
+        else:
+            raise ValueError("%s is not a pcap file" % filename)
+        linktype, = struct.unpack(endian + 'I', header[20:24])
+        if linktype != self.LINKTYPE_ETHERNET:
+            raise ValueError("%s does not contain ethernet frames" % filename)
+        self.record = struct.Struct(endian + 'IIII')
+
+    def fileno(self):
+        return self.fo.fileno()
+
+    def close(self):
+        self.fo.close()
+
+    def frames(self):
+        while True:
+            header = self.fo.read(self.record.size)
+            if len(header) < self.record.size:
+                return
+            _, _, caplen, _ = self.record.unpack(header)
+            yield None, self.fo.read(caplen)
+
+
+class RingCapture(object):
+    """
+    Capture backend built on TPACKET_V3 ring mapped into user space.
+    Kernel fills whole blocks of frames and hands them over in one
+    wakeup, so there is no syscall and no copy per frame.
+    """
+    block_size = 1 << 20
+    block_nr = 16
+    frame_size = 2048
+    # Partially filled block is handed over after this many milliseconds
+    retire_tov = 50
+
+    def __init__(self, iface, program):
+        self.iface = iface
+        # Socket is bound to ETH_P_ALL only after filter is attached,
+        # so no frames get into it unfiltered.
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            attach_bpf(self.sock, program)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION,
+                                 struct.pack('=i', TPACKET_V3))
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+                '=IIIIIII', self.block_size, self.block_nr, self.frame_size,
+                self.block_size * self.block_nr // self.frame_size,
+                self.retire_tov, 0, 0))
+            self.ring = mmap.mmap(self.sock.fileno(),
+                                  self.block_size * self.block_nr,
+                                  mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            self.sock.bind((iface, ETH_P_ALL))
+            # The same as pcap does. NICs filtering vlans in hardware
+            # drop frames of vlans without vlan interfaces otherwise.
+            self._promisc(PACKET_ADD_MEMBERSHIP)
+        except (socket.error, EnvironmentError):
+            self.sock.close()
+            raise
+        self.block = 0
+
+    def _promisc(self, action):
+        self.sock.setsockopt(SOL_PACKET, action, PACKET_MREQ.pack(
+            _iface_index(self.iface), PACKET_MR_PROMISC, 0, ''))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        try:
+            self._promisc(PACKET_DROP_MEMBERSHIP)
+        except (socket.error, EnvironmentError):
+            # interface has gone, kernel drops membership with socket
+            pass
+        self.ring.close()
+        self.sock.close()
+
+    def frames(self):
+        """
+        Yields (vlan, frame) for every frame in blocks filled so far.
+        Vlan is None if kernel left 802.1Q header in frame. Socket is
+        readable as soon as the next block is filled.
+        """
+        while self._block_ready():
+            offset = self.block * self.block_size
+            _, num_pkts, first = BLOCK_DESC.unpack_from(self.ring,
+                                                        offset + 8)
+            pkt = offset + first
+            for i in xrange(num_pkts):
+                (next_offset, _, _, snaplen, _, status, mac, _, _,
+                 tci) = TPACKET3_HDR.unpack_from(self.ring, pkt)
+                vlan = None
+                if status & TP_STATUS_VLAN_VALID:
+                    vlan = tci & 0x0fff
+                yield vlan, self.ring[pkt + mac:pkt + mac + snaplen]
+                pkt += next_offset
+            # give block back to kernel
+            self.ring[offset + 8:offset + 12] = struct.pack(
+                '=I', TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_nr
+
+    def _block_ready(self):
+        status, = struct.unpack_from(
+            '=I', self.ring, self.block * self.block_size + 8)
+        return status & TP_STATUS_USER
+
+
+class VlanSet(object):
+    """
+    Set of vlan ids stored as 4095-bit bitmap in one integer, so union,
+    intersection and membership are single bitwise operations.
+    """
+    MAX_VLAN = 4094
+
+    def __init__(self, vlans=(), bits=0):
+        for vlan in vlans:
+            bits |= 1 << vlan
+        self.bits = bits
+
+    @classmethod
+    def parse(cls, vlan_string):
+        """
+        Parses strings like "10, 15, 201-210".
+        :raises:
+        ValueError with incorrect chunk as message
+        """
+        bits = 0
+        for chunk in vlan_string.split(","):
+            delim = chunk.find("-")
+            try:
+                if delim > 0:
+                    left = int(chunk[:delim])
+                    right = int(chunk[delim + 1:])
+                else:
+                    left = right = int(chunk)
+            except ValueError:
+                raise ValueError(chunk)
+            if not (0 <= left <= cls.MAX_VLAN and 0 <= right <= cls.MAX_VLAN):
+                raise ValueError(chunk)
+            if left <= right:
+                bits |= ((1 << (right - left + 1)) - 1) << left
+        return cls(bits=bits)
+
+    def __contains__(self, vlan):
+        return bool(self.bits >> vlan & 1)
+
+    def __iter__(self):
+        # bin() gives the most significant bit first
+        for vlan, bit in enumerate(reversed(bin(self.bits)[2:])):
+            if bit == '1':
+                yield vlan
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __eq__(self, other):
+        return self.bits == other.bits
+
+    def __ne__(self, other):
+        return self.bits != other.bits
+
+    def __or__(self, other):
+        return VlanSet(bits=self.bits | other.bits)
+
+    def __and__(self, other):
+        return VlanSet(bits=self.bits & other.bits)
+
+    union = __or__
+    intersection = __and__
+
+    def ranges(self):
+        """
+        :returns:
+        sorted list of (first, last) vlan ranges
+        """
+        ranges = []
+        for vlan in self:
+            if ranges and ranges[-1][1] == vlan - 1:
+                ranges[-1][1] = vlan
+            else:
+                ranges.append([vlan, vlan])
+        return [tuple(r) for r in ranges]
+
+    def __str__(self):
+        return ",".join(
+            str(first) if first == last else "%d-%d" % (first, last)
+            for first, last in self.ranges())
+
+
+class NeighbourStore(object):
+    """
+    Compact storage of neighbours seen by listener. Every (uid, riface)
+    pair is interned into integer id once and each (iface, vlan) keeps
+    a bitmap of pair ids, so a duplicate frame costs one dict lookup and
+    one bit test.
+    """
+    def __init__(self):
+        self.pairs = {}
+        self.pair_list = []
+        self.vlans = {}
+        self.count = 0
+
+    def add_iface(self, iface):
+        self.vlans.setdefault(iface, {})
+
+    def add(self, iface, vlan, uid, riface):
+        """
+        :returns:
+        True if (uid, riface) has not been seen on iface with vlan before
+        """
+        key = (uid, riface)
+        pair = self.pairs.get(key)
+        if pair is None:
+            pair = self.pairs[key] = len(self.pair_list)
+            self.pair_list.append(key)
+
+        vlans = self.vlans.setdefault(iface, {})
+        bitmap = vlans.get(vlan)
+        if bitmap is None:
+            bitmap = vlans[vlan] = bytearray()
+        byte, bit = pair >> 3, 1 << (pair & 7)
+        if byte >= len(bitmap):
+            bitmap.extend(bytearray(byte + 1 - len(bitmap)))
+        elif bitmap[byte] & bit:
+            return False
+        bitmap[byte] |= bit
+        self.count += 1
+        return True
+
+    def dump(self):
+        """
+        :returns:
+        neighbours as {iface: {vlan: {uid: [riface, ...]}}}
+        """
+        result = {}
+        for iface, vlans in self.vlans.iteritems():
+            result[iface] = {}
+            for vlan, bitmap in vlans.iteritems():
+                uids = result[iface][vlan] = {}
+                for byte, bits in enumerate(bitmap):
+                    for bit in xrange(8):
+                        if bits & (1 << bit):
+                            uid, riface = self.pair_list[byte * 8 + bit]
+                            uids.setdefault(uid, []).append(riface)
+        return result
+
+
+class StreamDump(object):
+    """
+    Dump of neighbours kept up to date while listener works. Newly seen
+    neighbours are appended to line-delimited stream file, which is
+    periodically compacted into dump file, so dump file with stream file
+    always describe everything captured so far.
+    """
+    def __init__(self, dump_file, stream_file, interval):
+        self.dump_file = dump_file
+        self.stream_file = stream_file
+        self.interval = interval
+        self.stream = open(stream_file, 'w')
+        self.compacted_at = time.time()
+
+    def append(self, iface, vlan, uid, riface):
+        self.stream.write(json.dumps([iface, vlan, uid, riface]) + '\n')
+
+    def flush(self, store):
+        self.stream.flush()
+        if time.time() - self.compacted_at >= self.interval:
+            self.compact(store)
+
+    def compact(self, store):
+        tmp_file = '%s.tmp' % self.dump_file
+        with open(tmp_file, 'w') as fo:
+            fo.write(json.dumps(store.dump()))
+        os.rename(tmp_file, self.dump_file)
+        self.stream.seek(0)
+        self.stream.truncate()
+        self.compacted_at = time.time()
+
+    def close(self, store):
+        self.compact(store)
+        self.stream.close()
+        os.unlink(self.stream_file)
+
+    def remove(self):
+        self.stream.close()
+        for path in (self.dump_file, self.stream_file,
+                     '%s.tmp' % self.dump_file):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class Expectation(object):
+    """
+    Tracks which of expected uids have not been seen yet on every
+    interface and vlan. Expected uids are given as
+    {iface: {vlan_list_string: [uid, ...]}}.
+    """
+    def __init__(self, expected, parse_vlan_list):
+        self.missing = {}
+        for iface, vlans in expected.iteritems():
+            for vlan_string, uids in vlans.iteritems():
+                uids = [str(uid) for uid in uids]
+                for vlan in parse_vlan_list(str(vlan_string)):
+                    self.missing[(str(iface), vlan)] = set(uids)
+
+    def seen(self, iface, vlan, uid):
+        missing = self.missing.get((iface, vlan))
+        if missing and uid in missing:
+            missing.remove(uid)
+            if not missing:
+                del self.missing[(iface, vlan)]
+
+    def complete(self):
+        return not self.missing
+
+
+class Histogram(object):
+    """
+    Histogram of durations with power of two buckets of microseconds.
+    Bucket i counts durations shorter than 2 ** i microseconds, the last
+    one counts longer durations too.
+    """
+    def __init__(self, buckets=24):
+        self.buckets = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        # int.bit_length() is not available in Python 2.6
+        microseconds = int(seconds * 1000000)
+        bucket = len(bin(microseconds)) - 2 if microseconds > 0 else 0
+        self.buckets[min(bucket, len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def dump(self):
+        return {
+            'count': self.count,
+            'mean_us': (1000000 * self.total / self.count
+                        if self.count else None),
+            'buckets_us': dict(('<%d' % (1 << i), n)
+                               for i, n in enumerate(self.buckets) if n),
+        }
+
+
+class Metrics(object):
+    """
+    Listener frame counters per interface and vlan along with histograms
+    of time spent on every frame and on every batch of frames read from
+    one capture. Vlan of frames which could not be decoded is unknown.
+    Every captured frame is counted in exactly one of filtered, matched,
+    duplicates and decode_errors as well.
+    """
+    COUNTERS = ('captured', 'filtered', 'matched', 'duplicates',
+                'decode_errors')
+
+    def __init__(self, metrics_file=None, interval=10):
+        self.counters = {}
+        self.frame_time = Histogram()
+        self.batch_time = Histogram()
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.emitted_at = time.time()
+
+    def add(self, iface, vlan, counter):
+        vlans = self.counters.get(iface)
+        if vlans is None:
+            vlans = self.counters[iface] = {}
+        counts = vlans.get(vlan)
+        if counts is None:
+            counts = vlans[vlan] = dict.fromkeys(self.COUNTERS, 0)
+        counts[counter] += 1
+
+    def totals(self):
+        totals = dict.fromkeys(self.COUNTERS, 0)
+        for vlans in self.counters.itervalues():
+            for counts in vlans.itervalues():
+                for counter, value in counts.iteritems():
+                    totals[counter] += value
+        return totals
+
+    def dump(self):
+        counters = {}
+        for iface, vlans in self.counters.iteritems():
+            counters[iface] = dict(
+                ('unknown' if vlan is None else str(vlan), counts)
+                for vlan, counts in vlans.iteritems())
+        return {
+            'time': time.time(),
+            'totals': self.totals(),
+            'counters': counters,
+            'frame_time': self.frame_time.dump(),
+            'batch_time': self.batch_time.dump(),
+        }
+
+    def emit(self, logger, force=False):
+        """
+        Writes metrics into metrics file every interval seconds and logs
+        their totals.
+        """
+        if not force and time.time() - self.emitted_at < self.interval:
+            return
+        self.emitted_at = time.time()
+        logger.info("Frame totals: %s", json.dumps(self.totals()))
+        if self.metrics_file:
+            tmp_file = '%s.tmp' % self.metrics_file
+            with open(tmp_file, 'w') as fo:
+                fo.write(json.dumps(self.dump()))
+            os.rename(tmp_file, self.metrics_file)
+
+
+class Session(object):
+    """
+    One verification served by listener. Probes are assigned to it by
+    destination port and cookie, and it has its own neighbours, dump and
+    expectation, so several verifications can share one capture.
+    """
+    def __init__(self, config, parse_vlan_list):
+        self.config = config
+        self.name = str(config.get('name', config['cookie']))
+        self.cookie = str(config['cookie'])
+        self.dport = config['dport']
+        self.neighbours = NeighbourStore()
+        self.expectation = None
+        if config.get('expected'):
+            self.expectation = Expectation(config['expected'],
+                                           parse_vlan_list)
+        self.stream = None
+
+    def matches(self, dport, payload):
+        return dport == self.dport and payload.startswith(self.cookie)
+
+    def open_stream(self):
+        dump_file = self.config['dump_file']
+        self.stream = StreamDump(
+            dump_file,
+            self.config.get('stream_file', '%s.stream' % dump_file),
+            self.config.get('compact_interval', 30))
+
+    def add(self, iface, vlan, uid, riface):
+        """
+        :returns:
+        True if neighbour has not been seen before
+        """
+        if not self.neighbours.add(iface, vlan, uid, riface):
+            return False
+        self.stream.append(iface, vlan, uid, riface)
+        if self.expectation is not None:
+            self.expectation.seen(iface, vlan, uid)
+        return True
+
+    def flush(self):
+        self.stream.flush(self.neighbours)
+
+    def close(self):
+        self.stream.close(self.neighbours)
+
+    def remove_dump(self):
+        if self.stream is not None:
+            self.stream.remove()
+
+
 class Actor(object):
+    # Agent runs many actors in one process, 8021q is loaded only once.
+    _8021q_loaded = False
+
     def __init__(self, config=None):
         self.config = {
             'src_mac': None,
@@ -67,19 +1149,41 @@ class Actor(object):
             'sport': 31337,
             'dport': 31337,
             'cookie': "Nailgun:",
+            'engine': 'raw',
+            'tagged_raw': False,
+            'capture': 'pcap',
+            'debug_frames': False,
         }
         if config:
             self.config.update(config)
 
         self.logger.debug("Running with config: %s", json.dumps(self.config))
-        self._execute(["modprobe", "8021q"])
+        self._vlan_sets = {}
+        if self._vifaces_needed() and not Actor._8021q_loaded:
+            self._execute(["modprobe", "8021q"])
+            Actor._8021q_loaded = True
         self.iface_down_after = {}
         self.viface_remove_after = {}
+        try:
+            self.links = LinkCache()
+        except socket.error as e:
+            self.logger.debug("Netlink is not available, falling back "
+                              "to parsing 'ip link' output: %s", e)
+            self.links = None
+
+    def _close_links(self):
+        if self.links is not None:
+            self.links.close()
+            self.links = None
 
     def _define_logger(self, filename=None,
                        appname='netprobe', level=logging.DEBUG):
         logger = logging.getLogger()
         logger.setLevel(level)
+        # Actor created in a process forked from another one must not
+        # write into log of its parent.
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
 
         syslog_formatter = logging.Formatter(
             '{appname}: %(message)s'.format(appname=appname)
@@ -101,12 +1205,13 @@ class Actor(object):
 
         return logger
 
-    def _execute(self, command, expected_exit_codes=(0,)):
+    def _execute(self, command, expected_exit_codes=(0,), stdin_data=None):
         self.logger.debug("Running command: %s" % " ".join(command))
         env = os.environ
         env["PATH"] = "/bin:/usr/bin:/sbin:/usr/sbin"
-        p = Popen(command, shell=False, env=env, stdout=PIPE)
-        output, err = p.communicate()
+        p = Popen(command, shell=False, env=env, stdout=PIPE,
+                  stdin=PIPE if stdin_data is not None else None)
+        output, err = p.communicate(stdin_data)
         if p.returncode not in expected_exit_codes:
             raise ActorException(
                 self.logger,
@@ -128,6 +1233,15 @@ class Actor(object):
         if vid:
             viface = self._viface_by_iface_vid(iface, vid)
 
+        if self.links is not None:
+            state = self.links.state(viface or iface)
+            if state:
+                return (iface, viface, state)
+            raise ActorException(
+                self.logger,
+                "Cannot find interface %s with vid=%s" % (iface, vid)
+            )
+
         command = ['ip', 'link']
         r = re.compile(ur"(\d+?):\s+((?P<viface>[^:@]+)@)?(?P<iface>[^:]+?):"
                        ".+?(?P<state>UP|DOWN|UNKNOWN).*$")
@@ -219,6 +1333,8 @@ class Actor(object):
         """
         self.logger.debug("Checking if vlan %s on interface %s exists",
                           str(vid), iface)
+        if self.links is not None:
+            return self.links.vlan_name(iface, vid)
         with open("/proc/net/vlan/config", "r") as f:
             for line in f:
                 m = re.search(ur'(.+?)\s+\|\s+(.+?)\s+\|\s+(.+?)\s*$', line)
@@ -277,30 +1393,30 @@ class Actor(object):
             self.viface_remove_after.pop(viface)
 
     def _parse_vlan_list(self, vlan_string):
+        """
+        Parses vlan list string only once per string.
+        :returns:
+        VlanSet
+        """
+        vlans = self._vlan_sets.get(vlan_string)
+        if vlans is not None:
+            return vlans
         self.logger.debug("Parsing vlan list: %s", vlan_string)
-        validate = lambda x: (x >= 0) and (x < 4095)
-        chunks = vlan_string.split(",")
-        vlan_list = []
-        for chunk in chunks:
-            delim = chunk.find("-")
-            try:
-                if delim > 0:
-                    left = int(chunk[:delim])
-                    right = int(chunk[delim + 1:])
-                    if validate(left) and validate(right):
-                        vlan_list.extend(xrange(left, right + 1))
-                    else:
-                        raise ValueError
-                else:
-                    vlan = int(chunk)
-                    if validate(vlan):
-                        vlan_list.append(vlan)
-                    else:
-                        raise ValueError
-            except ValueError:
-                raise ActorException(self.logger, "Incorrect vlan: %s" % chunk)
-        self.logger.debug("Parsed vlans: %s", str(vlan_list))
-        return vlan_list
+        try:
+            vlans = VlanSet.parse(vlan_string)
+        except ValueError as e:
+            raise ActorException(self.logger, "Incorrect vlan: %s" % e)
+        self.logger.debug("Parsed vlans: %s", str(vlans))
+        self._vlan_sets[vlan_string] = vlans
+        return vlans
+
+    def _vifaces_needed(self):
+        """
+        In tagged raw mode 802.1Q headers are written straight into frames
+        sent on parent interface and tagged traffic is captured on parent
+        interface too, so vlan interfaces are never created.
+        """
+        return not self.config['tagged_raw']
 
     def _ensure_viface_create_and_up(self, iface, vid):
         self._ensure_viface_create(iface, vid)
@@ -310,6 +1426,80 @@ class Actor(object):
         self._ensure_iface_down(iface, vid)
         self._ensure_viface_remove(iface, vid)
 
+    def _execute_ip_batch(self, commands):
+        """
+        Runs all commands with a single 'ip -batch' process. It goes on
+        after failed commands, so the caller has to check results.
+        """
+        if not commands:
+            return
+        self.logger.debug("Running %d commands with ip -batch",
+                          len(commands))
+        self._execute(["ip", "-force", "-batch", "-"],
+                      expected_exit_codes=(0, 1),
+                      stdin_data="\n".join(commands) + "\n")
+
+    def _ensure_vifaces_create_and_up(self, iface_vids):
+        """
+        Bulk version of _ensure_viface_create_and_up. Missing vlan
+        interfaces are created and brought up by one 'ip -batch' run.
+        Only interfaces which really have been created or brought up are
+        marked to be removed or brought down after probing procedure.
+        """
+        commands = []
+        to_create = []
+        to_bring_up = []
+        for iface, vid in iface_vids:
+            viface = self._try_viface_create(iface, vid)
+            if not viface:
+                viface = "%s.%d" % (iface, vid)
+                commands.append("link add link %s name %s type vlan id %d" %
+                                (iface, viface, vid))
+                to_create.append((iface, vid))
+            elif self._try_iface_up(iface, vid):
+                continue
+            commands.append("link set dev %s up" % viface)
+            to_bring_up.append((iface, vid))
+        self._execute_ip_batch(commands)
+
+        failed = []
+        for iface, vid in to_create:
+            viface = self._try_viface_create(iface, vid)
+            if viface:
+                self.viface_remove_after[viface] = True
+            else:
+                failed.append((iface, vid))
+        for iface, vid in to_bring_up:
+            if (iface, vid) in failed:
+                continue
+            if self._try_iface_up(iface, vid):
+                self.iface_down_after[self._iface_name(iface, vid)] = True
+            else:
+                failed.append((iface, vid))
+        if failed:
+            raise ActorException(
+                self.logger,
+                "Can not create or bring up vlans on interfaces: %s" %
+                ", ".join("%s.%d" % (iface, vid) for iface, vid in failed)
+            )
+
+    def _ensure_vifaces_down_and_remove(self, iface_vids):
+        """
+        Bulk version of _ensure_viface_down_and_remove. Vlan interfaces
+        marked after their creation are removed and those marked after
+        bringing up are brought down by one 'ip -batch' run.
+        """
+        commands = []
+        for iface, vid in iface_vids:
+            viface = self._viface_by_iface_vid(iface, vid)
+            if self.viface_remove_after.pop(viface, False):
+                # removed interface does not need to be brought down
+                self.iface_down_after.pop(viface, None)
+                commands.append("link del dev %s" % viface)
+            elif self.iface_down_after.pop(viface, False):
+                commands.append("link set dev %s down" % viface)
+        self._execute_ip_batch(commands)
+
     def _iface_vlan_iterator(self):
         for iface, vlan_list in self.config['interfaces'].iteritems():
             # Variables iface and vlan_list are getted from decoded JSON
@@ -334,31 +1524,224 @@ class Actor(object):
 
 class Sender(Actor):
 
-    def __init__(self, config=None):
-        self.logger = self._define_logger('/root/netprobe_sender.log',
-                                          'netprobe_sender')
+    _sched_setaffinity = _libc_function('sched_setaffinity')
+
+    def __init__(self, config=None, logger=None):
+        self.logger = logger or self._define_logger(
+            '/root/netprobe_sender.log', 'netprobe_sender')
         super(Sender, self).__init__(config)
         self.logger.info("=== Starting Sender ===")
+        if not self._vifaces_needed() and self.config['engine'] != 'raw':
+            self.logger.debug("Tagged raw mode requires raw engine")
+            self.config['engine'] = 'raw'
         self._log_ifaces("Interfaces just before sending probing packages")
 
     def run(self):
         try:
-            self._run()
+            return self._run()
         except Exception as e:
             self.logger.error("An internal error occured: %s\n%s", str(e),
                               traceback.format_exc())
 
     def _run(self):
+        """
+        :returns:
+        (number of packets sent, seconds spent on sending) for raw engine
+        and None for scapy one
+        """
+        result = None
+        if self.config['engine'] == 'raw':
+            result = self._run_raw()
+        else:
+            self._run_scapy()
+
+        self._log_ifaces("Interfaces just after sending probing packages")
+        for iface in self._iface_iterator():
+            self._ensure_iface_down(iface)
+        self._log_ifaces("Interfaces just after ensuring them down in sender")
+        self.logger.info("=== Sender Finished ===")
+        return result
+
+    def _probe_data(self, iface):
+        return str(''.join((self.config['cookie'], iface, ' ',
+                            self.config['uid'])))
+
+    def _iface_mac(self, iface):
+        with open("/sys/class/net/%s/address" % iface, "r") as f:
+            return f.read().strip()
+
+    def _run_raw(self):
+        """
+        Sends probes through one AF_PACKET socket per physical interface.
+        802.1Q tags are written into frames here, so no vlan interfaces
+        are needed for sending.
+        :returns:
+        (number of packets sent, seconds spent on sending)
+        """
+        queues = []
+        try:
+            for iface, vlan_list in self.config['interfaces'].iteritems():
+                iface = str(iface)
+                self._ensure_iface_up(iface)
+                vlans = self._parse_vlan_list(str(vlan_list))
+                probe = ProbeFrame(
+                    self.config['src_mac'] or self._iface_mac(iface),
+                    self.config['src'], self.config['dst'],
+                    self.config['sport'], self.config['dport'],
+                    self._probe_data(iface))
+                self.logger.debug("Sending packets: iface=%s vlans=%s",
+                                  iface, str(vlan_list))
+                try:
+                    sock = self._open_socket(iface)
+                except socket.error as e:
+                    self.logger.error("Socket error: %s, %s", e, iface)
+                    continue
+                queues.append((sock, self._iface_frames(probe, vlans)))
+            if self.config.get('parallel', True) and len(queues) > 1:
+                return self._transmit_parallel(queues)
+            return self._transmit(list(queues), self.config.get('pps', 0))
+        finally:
+            for sock, _ in queues:
+                self._close_socket(sock)
+
+    def _open_socket(self, iface):
+        return RawSocket(iface)
+
+    def _close_socket(self, sock):
+        sock.close()
+
+    def _send_failed(self, sock):
+        pass
+
+    def _iface_frames(self, probe, vlans):
+        """
+        Yields all frames for one interface. Every repeat is a separate
+        pass over all vlans, so copies of one frame are spread in time.
+        """
+        for i in xrange(self.config.get('repeat', 5)):
+            for vlan in vlans:
+                yield probe.frame(vlan)
+
+    def _transmit_parallel(self, queues):
+        """
+        Runs one worker thread per interface, 'pps' is shared equally
+        between them. Workers are released all at once by one start
+        event, so total time is set by the busiest interface rather than
+        by the sum of them. Sockets send without holding GIL. A worker
+        which has died fails the whole run, its frames were not sent.
+        """
+        pps = float(self.config.get('pps', 0)) / len(queues)
+        start = threading.Event()
+        workers = []
+        results = []
+        failed = []
+        for number, queue in enumerate(queues):
+            ready = threading.Event()
+            t = threading.Thread(
+                target=self._transmit_worker,
+                args=(number, queue, pps, ready, start, results, failed)
+            )
+            t.daemon = True
+            t.start()
+            workers.append((t, ready))
+        for t, ready in workers:
+            ready.wait()
+        began = time.time()
+        start.set()
+        for t, _ in workers:
+            while t.is_alive():
+                t.join(1)
+        elapsed = time.time() - began
+        if failed:
+            raise ActorException(
+                self.logger,
+                "Sending packets has failed on interfaces: %s" %
+                ", ".join(sorted(failed)))
+        self.logger.info("All interfaces have sent packets in %.3f seconds",
+                         elapsed)
+        return sum(sent for sent, _ in results), elapsed
+
+    def _transmit_worker(self, number, queue, pps, ready, start, results,
+                         failed):
+        if self.config.get('pin_cpus'):
+            self._pin_thread(number)
+        ready.set()
+        start.wait()
+        try:
+            results.append(self._transmit([queue], pps))
+        except Exception as e:
+            self.logger.error("An internal error occured: %s\n%s", str(e),
+                              traceback.format_exc())
+            failed.append(queue[0].iface)
+
+    def _pin_thread(self, number):
+        """
+        Pins calling thread to CPU number modulo count of online CPUs.
+        """
+        cpu = number % os.sysconf('SC_NPROCESSORS_ONLN')
+        bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+        mask = (ctypes.c_ulong * (cpu // bits + 1))()
+        mask[cpu // bits] = 1 << (cpu % bits)
+        # pid 0 stands for calling thread
+        if (self._sched_setaffinity is None or self._sched_setaffinity(
+                0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0):
+            self.logger.debug("Can not pin sender thread to CPU %d", cpu)
+
+    def _transmit(self, queues, pps):
+        """
+        Sends bursts of frames taken from interfaces round-robin, so all
+        ports are busy at once. Overall rate is held at pps frames per
+        second if it is set.
+        """
+        burst = self.config.get('burst', 64)
+        start = time.time()
+        sent = 0
+        while queues:
+            for queue in list(queues):
+                sock, frames = queue
+                batch = list(itertools.islice(frames, burst))
+                if not batch:
+                    queues.remove(queue)
+                    continue
+                try:
+                    sock.send_frames(batch)
+                except socket.error as e:
+                    self.logger.error("Socket error: %s, %s", e, sock.iface)
+                    self._send_failed(sock)
+                    queues.remove(queue)
+                    continue
+                sent += len(batch)
+                if pps:
+                    delay = start + float(sent) / pps - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        elapsed = time.time() - start
+        self.logger.info("Sent %d packets in %.3f seconds, %d pps",
+                         sent, elapsed, sent / elapsed if elapsed else 0)
+        return sent, elapsed
+
+    def _run_scapy(self):
+        iface_vids = [(iface, vlan)
+                      for iface, vlan in self._iface_vlan_iterator()
+                      if vlan > 0]
+        for iface in self._iface_iterator():
+            self._ensure_iface_up(str(iface))
+        self.logger.debug("Ensure up: %d vlans", len(iface_vids))
+        try:
+            self._ensure_vifaces_create_and_up(iface_vids)
+            self._send_scapy()
+        finally:
+            self.logger.debug("Ensure down: %d vlans", len(iface_vids))
+            self._ensure_vifaces_down_and_remove(iface_vids)
+
+    def _send_scapy(self):
+        scapy = load_scapy()
         for iface, vlan in self._iface_vlan_iterator():
-            self._ensure_iface_up(iface)
-            data = str(''.join((self.config['cookie'], iface, ' ',
-                       self.config['uid'])))
+            data = self._probe_data(iface)
             self.logger.debug("Sending packets: iface=%s vlan=%s",
                               iface, str(vlan))
 
             if vlan > 0:
-                self.logger.debug("Ensure up: %s, %s", iface, str(vlan))
-                self._ensure_viface_create_and_up(iface, vlan)
                 viface = self._viface_by_iface_vid(iface, vlan)
             else:
                 viface = iface
@@ -370,36 +1753,75 @@ class Sender(Actor):
                               dport=self.config['dport']) / data
 
             try:
-                for i in xrange(5):
-                    self.logger.debug("Sending packet: iface=%s data=%s",
-                                      viface, data)
+                for i in xrange(self.config.get('repeat', 5)):
+                    if self.config['debug_frames']:
+                        self.logger.debug("Sending packet: iface=%s data=%s",
+                                          viface, data)
                     scapy.sendp(p, iface=viface)
             except socket.error as e:
                 self.logger.error("Socket error: %s, %s", e, viface)
 
-            if vlan > 0:
-                self.logger.debug("Ensure down: %s, %s", iface, str(vlan))
-                self._ensure_viface_down_and_remove(iface, vlan)
 
-        self._log_ifaces("Interfaces just after sending probing packages")
-        for iface in self._iface_iterator():
-            self._ensure_iface_down(iface)
-        self._log_ifaces("Interfaces just after ensuring them down in sender")
-        self.logger.info("=== Sender Finished ===")
+class Listener(Actor):
 
+    piddir = '/var/run/net_probe'
+    status_timeout = 5
 
-class Listener(Actor):
-    def __init__(self, config=None):
-        self.logger = self._define_logger('/root/netprobe_listener.log',
-                                          'netprobe_listener')
+    def __init__(self, config=None, logger=None):
+        self.logger = logger or self._define_logger(
+            '/root/netprobe_listener.log', 'netprobe_listener')
         super(Listener, self).__init__(config)
         self.logger.info("=== Starting Listener ===")
-        self._log_ifaces("Interfaces just before starting listerning "
-                         "for probing packages")
-
-        self.pidfile = self.addpid('/var/run/net_probe')
-
-        self.neighbours = {}
+        self.pidfile = None
+        if not self.config.get('replay'):
+            self._log_ifaces("Interfaces just before starting listerning "
+                             "for probing packages")
+            self.pidfile = self.addpid(self.piddir) if self.piddir else None
+
+        self.sessions = self._define_sessions()
+        self.cookies = tuple(set(session.cookie
+                                 for session in self.sessions))
+        self.frame_counts = {}
+        self.metrics = Metrics(self.config.get('metrics_file'),
+                               self.config.get('metrics_interval', 10))
+        # logging every frame costs more than processing it
+        self.debug_frames = self.config['debug_frames']
+        self.deadline = None
+
+    def _define_sessions(self):
+        """
+        Listener config alone describes the only session. Otherwise
+        'sessions' is a list of configs overriding cookie, dport,
+        dump_file, stream_file, compact_interval and expected of it.
+        Probe belongs to the first session it matches. Session without
+        its own dump_file dumps into listener dump_file with session
+        number appended.
+        """
+        if not self.config.get('sessions'):
+            return [Session(self.config, self._parse_vlan_list)]
+        sessions = []
+        for number, overrides in enumerate(self.config['sessions']):
+            config = {
+                'cookie': self.config['cookie'],
+                'dport': self.config['dport'],
+                'compact_interval': self.config.get('compact_interval', 30),
+            }
+            config.update(overrides)
+            if 'dump_file' not in config:
+                if not self.config.get('dump_file'):
+                    raise ActorException(
+                        self.logger,
+                        "Session %d has no dump_file" % number)
+                config['dump_file'] = '%s.%d' % (self.config['dump_file'],
+                                                 number)
+            sessions.append(Session(config, self._parse_vlan_list))
+        return sessions
+
+    def _vifaces_needed(self):
+        # replay only reads pcap files, host interfaces are left alone
+        if self.config.get('replay'):
+            return False
+        return super(Listener, self)._vifaces_needed()
 
     def addpid(self, piddir):
         pid = os.getpid()
@@ -419,26 +1841,88 @@ class Listener(Actor):
 
     def _run(self):
         sniffers = set()
-        def run_listener_thread(iface, vlan=False):
-            t = threading.Thread(
-                target=self.get_probe_frames,
-                args=(iface, vlan)
-            )
-            t.daemon = True
-            t.start()
-            return t
+        sources = []
+        for session in self.sessions:
+            session.open_stream()
+        if self.config.get('replay'):
+            try:
+                self._replay()
+            finally:
+                self._finish()
+            return
+
+        iface_vids = []
+        if self._vifaces_needed():
+            iface_vids = [(iface, vlan)
+                          for iface, vlan in self._iface_vlan_iterator()
+                          if vlan > 0]
+        status = None
+        try:
+            status = self._open_status_socket()
+            if status:
+                sources.append(status)
+
+            for iface, vlan in self._iface_vlan_iterator():
+                if not iface in sniffers:
+                    self._ensure_iface_up(iface)
+                    sources.extend(self._open_captures(iface))
+                    sniffers.add(iface)
+            if iface_vids:
+                self.logger.debug("Ensure up: %d vlans", len(iface_vids))
+                self._ensure_vifaces_create_and_up(iface_vids)
+
+            self._report_ready()
+
+            if self.config.get('timeout'):
+                self.deadline = time.time() + self.config['timeout']
+            try:
+                self._capture_loop(sources)
+            except KeyboardInterrupt:
+                self.logger.debug("Interruption signal catched")
+            except SystemExit:
+                self.logger.debug("TERM signal catched")
+        finally:
+            for source in sources:
+                source.close()
+            if status:
+                os.unlink(self.config['status_socket'])
+
+            self._log_ifaces("Interfaces just before ensuring interfaces "
+                             "down")
+            # Frames are handled in this thread, so any error of a
+            # handler ends up here. Dumps are written even if bringing
+            # interfaces down fails.
+            try:
+                # interfaces created before a failure are marked, so they
+                # are removed here as well
+                if iface_vids:
+                    self.logger.debug("Ensure down: %d vlans",
+                                      len(iface_vids))
+                    self._ensure_vifaces_down_and_remove(iface_vids)
+
+                for iface in self._iface_iterator():
+                    self._ensure_iface_down(iface)
+                self._log_ifaces("Interfaces just after ensuring them down "
+                                 "in listener")
+            finally:
+                self._finish()
+
+    def _finish(self):
+        for session in self.sessions:
+            try:
+                session.close()
+            except EnvironmentError as e:
+                self.logger.error("Can not write dump %s: %s",
+                                  session.config['dump_file'], e)
+        self.metrics.emit(self.logger, force=True)
+        self._removepid()
+        self.logger.info("=== Listener Finished ===")
 
-        for iface, vlan in self._iface_vlan_iterator():
-            self._ensure_iface_up(iface)
-            if vlan > 0:
-                self.logger.debug("Ensure up: %s, %s", iface, str(vlan))
-                self._ensure_viface_create_and_up(iface, vlan)
-                viface = self._viface_by_iface_vid(iface, vlan)
-            if not iface in sniffers:
-                run_listener_thread(iface)
-                run_listener_thread(iface, vlan=True)
-                sniffers.add(iface)
+    def _removepid(self):
+        if self.pidfile:
+            os.unlink(self.pidfile)
 
+    def _report_ready(self):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((self.config.get('ready_address', 'locahost'),
@@ -446,7 +1930,7 @@ class Listener(Actor):
         except socket.error as e:
             self.logger.error("Socket error: %s", e)
         else:
-            self.logger.debug("Listener threads have been launched. "
+            self.logger.debug("Listener captures have been opened. "
                               "Reporting READY.")
             msg = "READY"
             total_sent = 0
@@ -461,82 +1945,692 @@ class Listener(Actor):
             s.shutdown(socket.SHUT_RDWR)
             s.close()
 
+    def fprn(self, vlan, dport, msg, iface):
+        if self.debug_frames:
+            self.logger.debug("Catched packet: vlan=%s len=%s payload=%s",
+                              str(vlan), len(msg), msg)
+
+        session = self._session(dport, msg)
+        if session is None:
+            if self.debug_frames:
+                self.logger.debug("Probe of unknown session: dport=%s",
+                                  dport)
+            self.metrics.add(iface, vlan, 'filtered')
+            return
         try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            self.logger.debug("Interruption signal catched")
-        except SystemExit:
-            self.logger.debug("TERM signal catched")
+            riface, uid = msg[len(session.cookie):].split(' ', 1)
+        except ValueError:
+            if self.debug_frames:
+                self.logger.debug("Wrong probe payload: %s", msg)
+            self.metrics.add(iface, vlan, 'decode_errors')
+            return
+        uid = uid.strip('\x00\n')
 
-        self._log_ifaces("Interfaces just before ensuring interfaces down")
+        counts = self.frame_counts.setdefault(iface, {})
+        counts[vlan] = counts.get(vlan, 0) + 1
+        if session.add(iface, vlan, uid, riface):
+            self.metrics.add(iface, vlan, 'matched')
+            self._add_neighbour(session, iface, vlan, uid, riface)
+        else:
+            self.metrics.add(iface, vlan, 'duplicates')
 
-        for iface, vlan in self._iface_vlan_iterator():
-            if vlan > 0:
-                self.logger.debug("Ensure down: %s, %s", iface, str(vlan))
-                self._ensure_viface_down_and_remove(iface, vlan)
+    def _add_neighbour(self, session, iface, vlan, uid, riface):
+        """
+        Called for every neighbour seen for the first time in session.
+        """
 
-        for iface in self._iface_iterator():
-            self._ensure_iface_down(iface)
-        self._log_ifaces("Interfaces just after ensuring them down in listener")
+    def _session(self, dport, msg):
+        for session in self.sessions:
+            if session.matches(dport, msg):
+                return session
+        return None
 
-        with open(self.config['dump_file'], 'w') as fo:
-            fo.write(json.dumps(self.neighbours))
-        os.unlink(self.pidfile)
-        self.logger.info("=== Listener Finished ===")
-
-    def fprn(self, p, iface):
+    def _open_captures(self, iface):
+        """
+        We do not use scapy filtering because it is slow. Instead we use
+        python binding to extreamely fast libpcap library or TPACKET_V3
+        ring with BPF program attached to filter out probing packages.
+        """
+        probes = []
+        for session in self.sessions:
+            session.neighbours.add_iface(iface)
+            if (session.dport, session.cookie) not in probes:
+                probes.append((session.dport, session.cookie))
 
-        if scapy.Dot1Q in p:
-            vlan = p[scapy.Dot1Q].vlan
+        if self.config['capture'] == 'ring':
+            try:
+                return [RingCapture(iface, probe_bpf_program(probes))]
+            except (socket.error, EnvironmentError, ValueError) as e:
+                # ValueError comes from BPF program too long for so many
+                # sessions, pcap compiles filter of any length
+                self.logger.error("Can not set up TPACKET_V3 ring on %s, "
+                                  "falling back to pcap: %s", iface, e)
+
+        # pcap puts interface into promiscuous mode, so in tagged raw mode
+        # frames of vlans without vlan interfaces are captured too.
+        return [PcapCapture(iface, probe_pcap_filter(probes)),
+                PcapCapture(iface, probe_pcap_filter(probes, vlan=True))]
+
+    def _replay(self):
+        """
+        Feeds frames from pcap files given as {iface: filename} through
+        decoding and aggregation as fast as possible. Interfaces are not
+        touched at all.
+        """
+        for iface, filename in self.config['replay'].iteritems():
+            iface = str(iface)
+            for session in self.sessions:
+                session.neighbours.add_iface(iface)
+            source = PcapFile(iface, str(filename))
+            started = time.time()
+            try:
+                count = self._process_frames(source)
+            finally:
+                source.close()
+            elapsed = time.time() - started
+            self.logger.info("Replayed %d frames from %s in %.3f seconds, "
+                             "%d frames per second", count, filename,
+                             elapsed, count / elapsed if elapsed else 0)
+
+    def _open_status_socket(self):
+        """
+        Opens unix socket reporting frame counts per interface and vlan
+        as JSON to everyone who connects to it.
+        """
+        path = self.config.get('status_socket')
+        if not path:
+            return None
+        if os.path.exists(path):
+            os.unlink(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        s.listen(5)
+        return s
+
+    def _send_status(self, status):
+        """
+        Accepts status client and queues status for it. Status is
+        written by event loop as fast as client reads it, so slow client
+        does not hold up capturing. Client which has not read it in
+        status_timeout seconds is dropped.
+        """
+        try:
+            conn, _ = status.accept()
+        except socket.error as e:
+            self.logger.debug("Can not accept status client: %s", e)
+            return
+        conn.setblocking(0)
+        data = json.dumps({
+            'frames': self.frame_counts,
+            'neighbours': sum(session.neighbours.count
+                              for session in self.sessions),
+            'metrics': self.metrics.dump(),
+        })
+        fd = conn.fileno()
+        self.status_clients[fd] = [
+            conn, data, 0, time.time() + self.status_timeout]
+        self.handlers[fd] = functools.partial(self._write_status, fd)
+        self.poller.register(fd, select.EPOLLOUT)
+
+    def _write_status(self, fd):
+        client = self.status_clients[fd]
+        conn, data, sent = client[:3]
+        try:
+            sent += conn.send(buffer(data, sent, 1 << 16))
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self.logger.debug("Can not send status: %s", e)
+            sent = len(data)
+        if sent < len(data):
+            client[2] = sent
         else:
-            vlan = 0
+            self._close_status_client(fd)
+
+    def _expire_status_clients(self):
+        now = time.time()
+        for fd, client in self.status_clients.items():
+            if client[3] < now:
+                self.logger.debug("Status client is too slow, dropping it")
+                self._close_status_client(fd)
+
+    def _close_status_client(self, fd):
+        conn = self.status_clients.pop(fd)[0]
+        self.poller.unregister(fd)
+        del self.handlers[fd]
+        conn.close()
+
+    def _capture_loop(self, sources):
+        """
+        Single event loop serving captures of all interfaces. Frames are
+        processed in this thread only, so aggregation needs no locks.
+        """
+        self.poller = select.epoll()
+        self.handlers = {}
+        self.status_clients = {}
+        for source in sources:
+            self.handlers[source.fileno()] = self._handler(source)
+            self.poller.register(source.fileno(), select.EPOLLIN)
+        try:
+            while not self._finished():
+                timeout = 1
+                if self.deadline is not None:
+                    timeout = max(0, min(1, self.deadline - time.time()))
+                for fd, _ in self.poller.poll(timeout):
+                    # handler of earlier event may have closed this one
+                    handler = self.handlers.get(fd)
+                    if handler:
+                        handler()
+                if self.status_clients:
+                    self._expire_status_clients()
+                for session in self.sessions:
+                    session.flush()
+                self.metrics.emit(self.logger)
+        finally:
+            for fd in self.status_clients.keys():
+                self._close_status_client(fd)
+            self.poller.close()
+
+    def _handler(self, source):
+        if isinstance(source, socket.socket):
+            return functools.partial(self._send_status, source)
+        return functools.partial(self._process_frames, source)
+
+    def _finished(self):
+        if all(session.expectation is not None and
+               session.expectation.complete() for session in self.sessions):
+            self.logger.info("All expected neighbours have been seen")
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.logger.info("Listener timeout has expired")
+            return True
+        return False
+
+    def _process_frames(self, source):
+        count = 0
+        iface = source.iface
+        metrics = self.metrics
+        started = time.time()
+        for vlan, frame in source.frames():
+            count += 1
+            frame_started = time.time()
+            probe = self._decode_frame(frame, iface, vlan)
+            if probe:
+                tag, dport, payload = probe
+                if vlan is None:
+                    vlan = tag
+                self.fprn(vlan, dport, payload, iface)
+            metrics.add(iface, vlan, 'captured')
+            metrics.frame_time.add(time.time() - frame_started)
+        if count:
+            metrics.batch_time.add(time.time() - started)
+        return count
+
+    def _decode_frame(self, pkt, iface=None, vlan=None):
+        """
+        Decodes frame with decode_probe_frame. Only frames it can not
+        parse are given to much slower scapy. Frame which is not a probe
+        is counted as filtered, or as decode error if it has not become
+        a probe even with scapy.
+        :returns:
+        (vlan, dport, payload) if frame is a probe or None otherwise
+        """
+        try:
+            probe = decode_probe_frame(pkt, self.cookies)
+        except ValueError as e:
+            if self.debug_frames:
+                self.logger.debug("Falling back to scapy: %s", str(e))
+            probe = self._decode_frame_scapy(pkt)
+            if not probe:
+                self.metrics.add(iface, vlan, 'decode_errors')
+                return None
+        if probe:
+            try:
+                probe[2].decode()
+                return probe
+            except UnicodeDecodeError:
+                pass
+        self.metrics.add(iface, vlan, 'filtered')
+        return None
+
+    def _decode_frame_scapy(self, pkt):
+        try:
+            scapy = load_scapy()
+            p = scapy.Ether(pkt)
+            received_msg = str(p[scapy.UDP].payload)[:p[scapy.UDP].len]
+            if not received_msg.startswith(self.cookies):
+                return None
+            dport = p[scapy.UDP].dport
+            if scapy.Dot1Q in p:
+                return p[scapy.Dot1Q].vlan, dport, received_msg
+            return 0, dport, received_msg
+        except Exception as e:
+            if self.debug_frames:
+                self.logger.debug("Error while filtering packet: %s",
+                                  str(e))
+            return None
 
-        self.logger.debug("Catched packet: vlan=%s len=%s payload=%s",
-                          str(vlan), p[scapy.UDP].len, p[scapy.UDP].payload)
+class Benchmark(Actor):
+    """
+    Loopback benchmark of probe throughput and loss. Listener runs on one
+    end of every veth pair and raw engine Sender on another one, each in
+    its own forked process. Send and receive rates, loss and resources
+    used by both processes are reported as JSON.
+    """
+    def __init__(self, config=None):
+        self.logger = self._define_logger('/root/netprobe_benchmark.log',
+                                          'netprobe_benchmark')
+        super(Benchmark, self).__init__(config)
+        self.logger.info("=== Starting Benchmark ===")
 
-        received_msg = str(p[scapy.UDP].payload)[:p[scapy.UDP].len]
-        decoded_msg = received_msg.decode()
-        riface, uid = decoded_msg[len(self.config["cookie"]):].split(' ', 1)
-        uid = uid.strip('\x00\n')
+    def _vifaces_needed(self):
+        # both listener and sender work in tagged raw mode
+        return False
+
+    def run(self):
+        try:
+            print json.dumps(self._run(), indent=4, sort_keys=True)
+        except Exception as e:
+            self.logger.error("An internal error occured: %s\n%s", str(e),
+                              traceback.format_exc())
+
+    def _run(self):
+        vlans = self.config.get('vlan_list', '1-4094')
+        pairs = [('npbench%da' % i, 'npbench%db' % i)
+                 for i in xrange(self.config.get('interface_count', 1))]
+        workdir = tempfile.mkdtemp(prefix='net-probe-benchmark-')
+        ready = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener_pid = None
+        try:
+            self._create_veths(pairs)
+            ready.bind(('127.0.0.1', 0))
+            ready.listen(1)
+            ready.settimeout(60)
+            status_socket = os.path.join(workdir, 'status')
+            listener_pid = self._fork(Listener, {
+                'action': 'listen',
+                'interfaces': dict((b, vlans) for a, b in pairs),
+                'cookie': self.config['cookie'],
+                'dport': self.config['dport'],
+                'tagged_raw': True,
+                'capture': self.config['capture'],
+                'dump_file': os.path.join(workdir, 'dump'),
+                'status_socket': status_socket,
+                'ready_address': '127.0.0.1',
+                'ready_port': ready.getsockname()[1],
+            })
+            conn, _ = ready.accept()
+            conn.recv(16)
+            conn.close()
+
+            sender_pid = self._fork(Sender, {
+                'action': 'generate',
+                'interfaces': dict((a, vlans) for a, b in pairs),
+                'uid': 'benchmark',
+                'cookie': self.config['cookie'],
+                'dport': self.config['dport'],
+                'tagged_raw': True,
+                'repeat': self.config.get('repeat', 5),
+                'pps': self.config.get('pps', 0),
+                'burst': self.config.get('burst', 64),
+            }, os.path.join(workdir, 'sent'))
+            sender = self._wait(sender_pid)
+            with open(os.path.join(workdir, 'sent')) as fo:
+                sent, elapsed = json.load(fo)
+
+            # let listener drain whatever is left in its buffers
+            time.sleep(self.config.get('settle_time', 1))
+            frames = self._query_status(status_socket)['frames']
+            os.kill(listener_pid, signal.SIGTERM)
+            listener = self._wait(listener_pid)
+            listener_pid = None
+        finally:
+            if listener_pid:
+                os.kill(listener_pid, signal.SIGKILL)
+                self._wait(listener_pid)
+            ready.close()
+            self._execute_ip_batch(["link del dev %s" % a for a, b in pairs])
+            shutil.rmtree(workdir)
+
+        received = sum(sum(counts.values()) for counts in frames.values())
+        report = {
+            'interfaces': len(pairs),
+            'vlans': len(self._parse_vlan_list(vlans)),
+            'sent': sent,
+            'received': received,
+            'send_pps': int(sent / elapsed) if elapsed else None,
+            'receive_pps': int(received / elapsed) if elapsed else None,
+            'loss_percent': (100.0 * (sent - received) / sent
+                             if sent else None),
+            'sender': sender,
+            'listener': listener,
+        }
+        self.logger.info("Benchmark results: %s", json.dumps(report))
+        self.logger.info("=== Benchmark Finished ===")
+        return report
+
+    def _create_veths(self, pairs):
+        commands = []
+        for a, b in pairs:
+            commands.append("link add %s type veth peer name %s" % (a, b))
+            commands.append("link set dev %s up" % a)
+            commands.append("link set dev %s up" % b)
+        self._execute_ip_batch(commands)
+        for a, b in pairs:
+            self._look_for_link(a)
+            self._look_for_link(b)
+
+    def _fork(self, actor_class, config, result_file=None):
+        """
+        Runs actor in a child process. Sender writes number of packets
+        sent and time spent on sending into result_file.
+        """
+        pid = os.fork()
+        if pid:
+            return pid
+        code = 0
+        logger = self.logger
+        try:
+            actor = actor_class(config)
+            logger = actor.logger
+            if result_file:
+                with open(result_file, 'w') as fo:
+                    fo.write(json.dumps(actor._run_raw()))
+            else:
+                actor.run()
+        except BaseException as e:
+            # os._exit skips interpreter cleanup, so nothing else would
+            # report what went wrong in the child
+            logger.error("Benchmark %s process failed: %s\n%s",
+                         actor_class.__name__, str(e),
+                         traceback.format_exc())
+            code = 1
+        os._exit(code)
+
+    def _wait(self, pid):
+        """
+        :returns:
+        CPU time and peak RSS of finished child process
+        """
+        _, status, usage = os.wait4(pid, 0)
+        if status:
+            raise ActorException(self.logger,
+                                 "Benchmark process %d failed" % pid)
+        return {
+            'cpu_seconds': usage.ru_utime + usage.ru_stime,
+            'max_rss_kb': usage.ru_maxrss,
+        }
+
+    def _query_status(self, path):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        chunks = []
+        while True:
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        s.close()
+        return json.loads(''.join(chunks))
+
+
+class AgentListener(Listener):
+    """
+    Listener job of Agent. Neighbours are streamed to client connection
+    as soon as they are found, and the job is stopped by client sending
+    "stop" line or closing its connection.
+    """
+
+    piddir = None
 
-        self.neighbours[iface].setdefault(vlan, {})
+    def __init__(self, config, conn, logger):
+        self.conn = conn
+        self.stopped = False
+        super(AgentListener, self).__init__(config, logger)
 
-        if riface not in self.neighbours[iface][vlan].setdefault(uid, []):
-            self.neighbours[iface][vlan][uid].append(riface)
+    def _report_ready(self):
+        self._send({'status': 'ready'})
 
-    def get_probe_frames(self, iface, vlan=False):
-        if not iface in self.neighbours:
-            self.neighbours[iface] = {}
+    def _add_neighbour(self, session, iface, vlan, uid, riface):
+        self._send({'neighbour': [iface, vlan, uid, riface],
+                    'session': session.name})
+
+    def _send(self, message):
         """
-        We do not use scapy filtering because it is slow. Instead we use
-        python binding to extreamely fast libpcap library to filter out
-        probing packages.
+        Client which has gone away stops the job, so listener is torn
+        down as usual.
         """
-        pc = pcap.pcap(iface)
-        filter_string = 'udp and dst port {0}'.format(self.config['dport'])
-        if vlan:
-            filter_string = 'vlan and {0}'.format(filter_string)
-        pc.setfilter(filter_string)
+        if self.stopped:
+            return
+        try:
+            send_line(self.conn, message)
+        except socket.error as e:
+            self.logger.info("Agent client has gone away: %s", e)
+            self.stopped = True
 
-        def fltr(p):
-            try:
-                received_msg = str(p[scapy.UDP].payload)[:p[scapy.UDP].len]
-                decoded_msg = received_msg.decode()
-                return decoded_msg.startswith(self.config["cookie"])
-            except Exception as e:
-                self.logger.debug("Error while filtering packet: %s", str(e))
-                return False
-
-        pprn = functools.partial(self.fprn, iface=iface)
+    def _capture_loop(self, sources):
+        super(AgentListener, self)._capture_loop(sources + [self.conn])
+
+    def _handler(self, source):
+        if source is self.conn:
+            return self._read_control
+        return super(AgentListener, self)._handler(source)
+
+    def _read_control(self):
+        try:
+            data = self.conn.recv(4096)
+        except socket.error as e:
+            self.logger.debug("Can not read agent client: %s", e)
+            data = ''
+        if not data or 'stop' in data:
+            self.logger.info("Listener has been stopped by agent client")
+            self.stopped = True
+
+    def _finished(self):
+        return self.stopped or super(AgentListener, self)._finished()
+
+
+class AgentSender(Sender):
+    """
+    Sender job of Agent. Raw sockets are taken from agent and stay open
+    after the job is done. Socket which has failed is given back to
+    agent to be reopened by the next job, and the job reports an error.
+    """
+
+    def __init__(self, config, agent):
+        self.agent = agent
+        self.failed = set()
+        super(AgentSender, self).__init__(config, agent.logger)
+
+    def _open_socket(self, iface):
+        return self.agent.raw_socket(iface)
+
+    def _close_socket(self, sock):
+        pass
+
+    def _send_failed(self, sock):
+        self.failed.add(sock.iface)
+        self.agent.drop_socket(sock)
+
+
+def send_line(conn, message):
+    conn.sendall(json.dumps(message) + '\n')
+
+
+class Agent(Actor):
+    """
+    Long running net_probe. Jobs are read as one JSON config line from
+    every connection to unix control socket and run in their own threads,
+    so scapy and pcap are imported and 8021q is loaded only once. Raw
+    sockets are kept open between jobs. Every job answers with JSON lines
+    ending with {"status": "done", ...} or {"status": "error", ...}.
+    """
+    def __init__(self, config=None):
+        self.logger = self._define_logger('/root/netprobe_agent.log',
+                                          'netprobe_agent')
+        super(Agent, self).__init__(config)
+        # every job has links of its own, agent cache would only pile up
+        # link events nobody reads
+        self._close_links()
+        self.logger.info("=== Starting Agent ===")
+        self.sockets = {}
+        self.listeners = set()
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as e:
+            self.logger.error("An internal error occured: %s\n%s", str(e),
+                              traceback.format_exc())
+
+    def _run(self):
+        path = self.config.get('control_socket', '/var/run/net_probe.sock')
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        workers = []
         try:
             while True:
-                ts, pkt = pc.next()
-                p = scapy.Ether(pkt)
-                if fltr(p):
-                    pprn(p)
-        except (KeyboardInterrupt, SystemExit):
-            pass
+                conn, _ = server.accept()
+                t = threading.Thread(target=self._serve, args=(conn,))
+                t.daemon = True
+                t.start()
+                workers = [w for w in workers if w.is_alive()] + [t]
+        except KeyboardInterrupt:
+            self.logger.debug("Interruption signal catched")
+        except SystemExit:
+            self.logger.debug("TERM signal catched")
+        finally:
+            server.close()
+            os.unlink(path)
+            # listeners notice it within one second and clean up vifaces
+            with self.lock:
+                for listener in self.listeners:
+                    listener.stopped = True
+            for t in workers:
+                t.join(self.config.get('stop_timeout', 10))
+            for _, sock in self.sockets.values():
+                sock.close()
+        self.logger.info("=== Agent Finished ===")
+
+    def raw_socket(self, iface):
+        """
+        Socket stays bound to ifindex it was opened on, so it is reopened
+        when interface has been recreated since then.
+        """
+        try:
+            index = _iface_index(iface)
+        except EnvironmentError:
+            # binding new socket reports missing interface
+            index = None
+        with self.lock:
+            cached = self.sockets.pop(iface, None)
+            if cached and cached[0] != index:
+                cached[1].close()
+                cached = None
+            self.sockets[iface] = cached or (index, RawSocket(iface))
+            return self.sockets[iface][1]
+
+    def drop_socket(self, sock):
+        with self.lock:
+            cached = self.sockets.get(sock.iface)
+            if cached and cached[1] is sock:
+                del self.sockets[sock.iface]
+                sock.close()
+
+    def _read_job(self, conn):
+        chunks = []
+        while True:
+            chunk = conn.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if '\n' in chunk:
+                break
+        return json.loads(''.join(chunks))
+
+    def _serve(self, conn):
+        job_id = next(self.job_ids)
+        try:
+            config = self._read_job(conn)
+            self.logger.info("Job %d: %s", job_id, config.get('action'))
+            if config.get('action') == 'listen':
+                scratch = None
+                if not config.get('dump_file'):
+                    # neighbours are sent in reply, so dump is only kept
+                    # while the job runs
+                    scratch = '/var/tmp/net-probe-dump-agent-%d' % job_id
+                    config['dump_file'] = scratch
+                self._reply(job_id, conn, self._listen(config, conn, scratch))
+            elif config.get('action') == 'generate':
+                self._reply(job_id, conn, self._generate(config))
+            else:
+                raise ActorException(
+                    self.logger,
+                    "Wrong job action: %s" % config.get('action'))
+        except Exception as e:
+            self.logger.error("Job %d failed: %s\n%s", job_id, str(e),
+                              traceback.format_exc())
+            try:
+                send_line(conn, {'status': 'error', 'message': str(e)})
+            except socket.error:
+                pass
+        finally:
+            conn.close()
+
+    def _reply(self, job_id, conn, message):
+        try:
+            send_line(conn, message)
+        except socket.error as e:
+            self.logger.info("Job %d: client has gone away: %s", job_id, e)
+
+    def _generate(self, config):
+        sender = AgentSender(config, self)
+        try:
+            result = sender._run()
+        finally:
+            sender._close_links()
+        message = {'status': 'done'}
+        if sender.failed:
+            message = {'status': 'error',
+                       'message': "Sending packets has failed on "
+                       "interfaces: %s" % ", ".join(sorted(sender.failed))}
+        if result:
+            message['sent'], message['elapsed'] = result
+        return message
+
+    def _listen(self, config, conn, scratch=None):
+        """
+        Dumps of sessions derived from scratch dump_file are removed
+        after the job.
+        """
+        listener = AgentListener(config, conn, self.logger)
+        with self.lock:
+            self.listeners.add(listener)
+        try:
+            listener._run()
+        finally:
+            with self.lock:
+                self.listeners.discard(listener)
+            listener._close_links()
+            if scratch:
+                for session in listener.sessions:
+                    dump_file = session.config['dump_file']
+                    if (dump_file == scratch or
+                            dump_file.startswith(scratch + '.')):
+                        session.remove_dump()
+        message = {'status': 'done',
+                   'neighbours': listener.sessions[0].neighbours.dump()}
+        if len(listener.sessions) > 1:
+            message['sessions'] = dict(
+                (session.name, session.neighbours.dump())
+                for session in listener.sessions)
+        return message
+
 
 # -------------- main ---------------
 
@@ -549,6 +2643,46 @@ Capture frames config file example is:
 {"action": "listen", "interfaces": {"eth0": "1-4094"},
  "dump_file": "/var/tmp/net-probe-dump-eth0"}
 
+Listener capturing through TPACKET_V3 ring config file example is:
+{"action": "listen", "interfaces": {"eth0": "1-4094"}, "capture": "ring",
+ "dump_file": "/var/tmp/net-probe-dump-eth0"}
+
+Listener streaming results and reporting its status config file example is:
+{"action": "listen", "interfaces": {"eth0": "1-4094"},
+ "dump_file": "/var/tmp/net-probe-dump-eth0",
+ "stream_file": "/var/tmp/net-probe-dump-eth0.stream",
+ "compact_interval": 30,
+ "status_socket": "/var/tmp/net-probe-status-eth0"}
+
+Listener exiting as soon as all expected neighbours are seen or
+after 120 seconds config file example is:
+{"action": "listen", "interfaces": {"eth0": "1-4094"},
+ "dump_file": "/var/tmp/net-probe-dump-eth0",
+ "expected": {"eth0": {"1-4094": ["aaa-bb-cccccc", "ddd-ee-ffffff"]}},
+ "timeout": 120}
+
+Listener writing frame counters and processing time histograms every
+10 seconds config file example is:
+{"action": "listen", "interfaces": {"eth0": "1-4094"},
+ "dump_file": "/var/tmp/net-probe-dump-eth0",
+ "metrics_file": "/var/tmp/net-probe-metrics-eth0",
+ "metrics_interval": 10, "debug_frames": false}
+
+Listener serving two verifications from one capture config file example
+is:
+{"action": "listen", "interfaces": {"eth0": "1-4094"},
+ "dump_file": "/var/tmp/net-probe-dump-eth0",
+ "sessions": [
+    {"cookie": "Cluster1:", "dump_file": "/var/tmp/net-probe-dump-1"},
+    {"cookie": "Cluster2:", "dport": 31339,
+     "dump_file": "/var/tmp/net-probe-dump-2"}]}
+
+Listener replaying recorded captures instead of listening config file
+example is:
+{"action": "listen", "interfaces": {},
+ "replay": {"eth0": "/var/tmp/eth0.pcap", "eth1": "/var/tmp/eth1.pcap"},
+ "dump_file": "/var/tmp/net-probe-dump-replay"}
+
 Simple frame generation config file example is:
 {"action": "generate", "uid": "aaa-bb-cccccc",
  "interfaces": { "eth0": "1-4094"}}
@@ -556,6 +2690,9 @@ Simple frame generation config file example is:
 Full frame generation config file example is:
 {   "action": "generate",
     "uid": "aaa-bb-cccccc", "cookie": "Some cookie",
+    "engine": "raw", "tagged_raw": true,
+    "pps": 100000, "burst": 64, "repeat": 5,
+    "parallel": true, "pin_cpus": true,
     "src_mac": "11:22:33:44:55:66",
     "src": "10.0.0.1", "dst": "10.255.255.255",
     "sport": 4056, "dport": 4057,
@@ -564,6 +2701,15 @@ Full frame generation config file example is:
         "eth1": "1-4094"
     }
 }
+
+Loopback benchmark config file example is:
+{"action": "benchmark", "interface_count": 4, "vlan_list": "1-4094",
+ "capture": "ring", "repeat": 5, "pps": 0}
+
+Agent config file example is:
+{"action": "agent", "control_socket": "/var/run/net_probe.sock"}
+Agent reads listen and generate configs above as one JSON line from every
+connection to its control socket. Listener job is stopped by "stop" line.
     """
 
     parser = argparse.ArgumentParser(epilog=config_examples)
@@ -571,6 +2717,10 @@ Full frame generation config file example is:
         '-c', '--config', dest='config', action='store', type=str,
         help='config file', default=None
     )
+    parser.add_argument(
+        '--profile-startup', dest='profile_startup', action='store_true',
+        help='report time spent on imports before running', default=False
+    )
     return parser
 
 
@@ -587,17 +2737,41 @@ def define_subparsers(parser):
     )
     listen_parser.add_argument(
         '-v', '--vlans', dest='vlan_list', action='store', type=str,
-        help='vlan list to send tagged packets ("100,200-300")', required=True
+        help='vlan list to send tagged packets ("100,200-300"), '
+        'not needed with --replay', default=None
     )
     listen_parser.add_argument(
         '-k', '--cookie', dest='cookie', action='store', type=str,
         help='cookie string to insert into probe packets payload',
         default='Nailgun:'
     )
+    listen_parser.add_argument(
+        '-t', '--tagged-raw', dest='tagged_raw', action='store_true',
+        help='capture tagged frames on parent interface without '
+        'creating vlan interfaces', default=False
+    )
+    listen_parser.add_argument(
+        '-r', '--capture', dest='capture', action='store', type=str,
+        choices=('pcap', 'ring'), help='capture backend', default='pcap'
+    )
     listen_parser.add_argument(
         '-o', '--file', dest='dump_file', action='store', type=str,
         help='file to dump captured packets', default=None
     )
+    listen_parser.add_argument(
+        '-s', '--status-socket', dest='status_socket', action='store',
+        type=str, help='unix socket to report frame counts on',
+        default=None
+    )
+    listen_parser.add_argument(
+        '-R', '--replay', dest='replay', action='store', type=str,
+        help='pcap file to process as if it was captured on interface',
+        default=None
+    )
+    listen_parser.add_argument(
+        '-T', '--timeout', dest='timeout', action='store', type=int,
+        help='seconds to listen before exiting', default=None
+    )
     listen_parser.add_argument(
         '-a', '--address', dest='ready_address', action='store', type=str,
         help='address to report listener ready state', default='localhost'
@@ -626,6 +2800,67 @@ def define_subparsers(parser):
         '-u', '--uid', dest='uid', action='store', type=str,
         help='uid to insert into probe packets payload', default='1'
     )
+    generate_parser.add_argument(
+        '-e', '--engine', dest='engine', action='store', type=str,
+        choices=('scapy', 'raw'), help='engine to send probe packets with',
+        default='raw'
+    )
+    generate_parser.add_argument(
+        '-r', '--repeat', dest='repeat', action='store', type=int,
+        help='number of packets to send to every vlan', default=5
+    )
+    generate_parser.add_argument(
+        '-P', '--pps', dest='pps', action='store', type=int,
+        help='packets per second limit for raw engine (0 is unlimited)',
+        default=0
+    )
+    generate_parser.add_argument(
+        '-b', '--burst', dest='burst', action='store', type=int,
+        help='packets sent to one interface in a row by raw engine',
+        default=64
+    )
+    generate_parser.add_argument(
+        '-S', '--serial', dest='parallel', action='store_false',
+        help='send from all interfaces in one thread with raw engine',
+        default=True
+    )
+    generate_parser.add_argument(
+        '-t', '--tagged-raw', dest='tagged_raw', action='store_true',
+        help='write 802.1Q tags into frames sent on parent interface '
+        'without creating vlan interfaces', default=False
+    )
+    benchmark_parser = subparsers.add_parser(
+        'benchmark', help='measure probe throughput and loss on veth pairs'
+    )
+    benchmark_parser.add_argument(
+        '-n', '--interfaces', dest='interface_count', action='store',
+        type=int, help='number of veth pairs', default=1
+    )
+    benchmark_parser.add_argument(
+        '-v', '--vlans', dest='vlan_list', action='store', type=str,
+        help='vlan list to send tagged packets ("100,200-300")',
+        default='1-4094'
+    )
+    benchmark_parser.add_argument(
+        '-r', '--capture', dest='capture', action='store', type=str,
+        choices=('pcap', 'ring'), help='capture backend', default='pcap'
+    )
+    benchmark_parser.add_argument(
+        '-R', '--repeat', dest='repeat', action='store', type=int,
+        help='number of packets to send to every vlan', default=5
+    )
+    benchmark_parser.add_argument(
+        '-P', '--pps', dest='pps', action='store', type=int,
+        help='packets per second limit (0 is unlimited)', default=0
+    )
+    agent_parser = subparsers.add_parser(
+        'agent', help='run jobs received on unix control socket'
+    )
+    agent_parser.add_argument(
+        '-s', '--socket', dest='control_socket', action='store', type=str,
+        help='unix socket to accept jobs on',
+        default='/var/run/net_probe.sock'
+    )
 
 
 def term_handler(signum, sigframe):
@@ -662,15 +2897,27 @@ if __name__ == "__main__":
         if params.action == 'listen':
             config['action'] = 'listen'
             config['interfaces'] = {}
-            config['interfaces'][params.interface] = params.vlan_list
+            if params.vlan_list:
+                config['interfaces'][params.interface] = params.vlan_list
+            elif not params.replay:
+                print "Vlan list is required unless --replay is set"
+                exit(1)
             config['cookie'] = params.cookie
+            config['tagged_raw'] = params.tagged_raw
+            config['capture'] = params.capture
+            if params.status_socket:
+                config['status_socket'] = params.status_socket
+            if params.timeout:
+                config['timeout'] = params.timeout
+            if params.replay:
+                config['replay'] = {params.interface: params.replay}
             config['ready_address'] = params.ready_address
             config['ready_port'] = params.ready_port
             if params.dump_file:
                 config['dump_file'] = params.dump_file
             else:
                 config['dump_file'] = "/var/tmp/net-probe-dump-%s" %\
-                    config['interface']
+                    params.interface
 
         elif params.action == 'generate':
             config['action'] = 'generate'
@@ -678,6 +2925,27 @@ if __name__ == "__main__":
             config['interfaces'][params.interface] = params.vlan_list
             config['uid'] = params.uid
             config['cookie'] = params.cookie
+            config['engine'] = params.engine
+            config['tagged_raw'] = params.tagged_raw
+            config['repeat'] = params.repeat
+            config['pps'] = params.pps
+            config['burst'] = params.burst
+            config['parallel'] = params.parallel
+
+        elif params.action == 'benchmark':
+            config['action'] = 'benchmark'
+            config['interface_count'] = params.interface_count
+            config['vlan_list'] = params.vlan_list
+            config['capture'] = params.capture
+            config['repeat'] = params.repeat
+            config['pps'] = params.pps
+
+        elif params.action == 'agent':
+            config['action'] = 'agent'
+            config['control_socket'] = params.control_socket
 
     actor = ActorFabric.getInstance(config)
+    if import_profiler:
+        import_profiler.uninstall()
+        sys.stderr.write(import_profiler.report() + '\n')
     actor.run()